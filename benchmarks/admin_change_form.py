@@ -0,0 +1,55 @@
+"""
+Time the news item admin change form with the template placeholder slots
+parsed on every call, as before newsy.placeholders.get_placeholders
+memoized them, and with the memoized slots.
+
+Run from a project that has newsy and the admin installed:
+
+    DJANGO_SETTINGS_MODULE=project.settings python -m benchmarks.admin_change_form
+
+The optional first argument is the number of requests timed (default 20).
+"""
+import sys
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+
+from newsy import placeholders
+from newsy.models import NewsItem
+
+from benchmarks.utils import setup_database, teardown_database, timed
+
+
+
+def _change_form(client, url, memoized):
+    def request():
+        if not memoized:
+            placeholders._slots_cache.clear()
+        response = client.get(url)
+        assert response.status_code == 200, response.status_code
+    return request
+
+def main(repeat=20):
+    old_name = setup_database()
+    try:
+        User.objects.create_superuser('benchmark', 'benchmark@example.com',
+                                      'benchmark')
+        item = NewsItem.objects.create(title=u'Benchmark', slug='benchmark',
+            template=settings.NEWSY_TEMPLATES[0][0])
+        client = Client()
+        client.login(username='benchmark', password='benchmark')
+        url = reverse('admin:newsy_newsitem_change', args=(item.pk,))
+
+        print 'change form of %s (best of %d requests)' % (url, repeat,)
+        for name, memoized in (('parsed per call', False,),
+                               ('memoized', True,),):
+            print '%-16s %8.2fms' % (name, timed(_change_form(client, url,
+                                                             memoized),
+                                                repeat),)
+    finally:
+        teardown_database(old_name)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,87 @@
+"""
+Regression benchmark for the archive pages and permalinks. The same number
+of items per day is seeded into a small and a large table, so an archive
+page or permalink that uses the publication_date index takes about as long
+on both, while one that scans the table slows down with its size.
+
+Run from a project that has newsy installed:
+
+    DJANGO_SETTINGS_MODULE=project.settings python -m benchmarks.archive
+
+The optional arguments are the small and large item counts (default 10000
+and 100000). Exits with status 1 when a lookup on the large table is not
+sub-linear, taken as slowing down by more than half the size ratio.
+"""
+import sys
+from datetime import datetime, timedelta
+
+from django.core.paginator import Paginator
+
+from newsy.models import NewsItem
+from newsy.views import NewsListView, get_item_for_date
+
+from benchmarks.utils import setup_database, teardown_database, seed, \
+    explain, timed
+
+
+
+ITEMS_PER_DAY = 3
+END = datetime(2012, 1, 1)
+
+def _archive_page(**kwargs):
+    view = NewsListView()
+    view.kwargs = kwargs
+    paginator = Paginator(view.get_queryset(), 15)
+    return (paginator.count, list(paginator.page(1).object_list),)
+
+def _permalink():
+    item = NewsItem.objects.filter(publication_date__lt=datetime(2008, 6, 16),
+        published=True).order_by('-publication_date')[0]
+    pub = item.publication_date
+    return lambda: get_item_for_date(pub.year, pub.month, pub.day, item.slug)
+
+def access_paths():
+    return (
+        ('year archive', lambda: _archive_page(year='2008')),
+        ('month archive', lambda: _archive_page(year='2008', month='6')),
+        ('day archive', lambda: _archive_page(year='2008', month='6',
+                                              day='15')),
+        ('permalink', _permalink()),
+    )
+
+def measure(count):
+    """
+    Seed count items in a fresh test database and return the best timing of
+    each access path as (name, milliseconds) pairs.
+    """
+    span_days = count / ITEMS_PER_DAY
+    old_name = setup_database()
+    try:
+        seed(count, start=END - timedelta(days=span_days), span_days=span_days)
+        view = NewsListView()
+        view.kwargs = {'year': '2008', 'month': '6'}
+        print 'month archive plan (%d items):' % (count,)
+        for line in explain(view.get_queryset()[:15]):
+            print '    %s' % (line,)
+        return [(name, timed(path)) for name, path in access_paths()]
+    finally:
+        teardown_database(old_name)
+
+def main(small=10000, large=100000):
+    small_timings = measure(small)
+    large_timings = measure(large)
+    limit = float(large) / small / 2
+
+    failed = False
+    print '%-16s %10s %10s %8s' % ('', '%d' % (small,), '%d' % (large,),
+                                   'ratio',)
+    for (name, small_ms), (name, large_ms) in zip(small_timings,
+                                                  large_timings):
+        ratio = large_ms / max(small_ms, 0.01)
+        print '%-16s %8.2fms %8.2fms %8.2f%s' % (name, small_ms, large_ms,
+            ratio, ratio > limit and ' FAIL' or '',)
+        failed = failed or ratio > limit
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:3]]))
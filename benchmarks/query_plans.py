@@ -0,0 +1,76 @@
+"""
+Print the query plans and timings of newsy's public queries on a test
+database seeded with news items, first with the composite indexes from
+migrations 0010 and 0012 and then with those indexes dropped.
+
+Run from a project that has newsy installed:
+
+    DJANGO_SETTINGS_MODULE=project.settings python -m benchmarks.query_plans
+
+The optional first argument is the number of items to seed (default 100000).
+"""
+import sys
+
+from django.conf import settings
+
+from newsy.feeds import RssNewsItemFeed
+from newsy.models import ArchiveEntry, LatestNewsPlugin
+from newsy.views import NewsListView
+
+from benchmarks.utils import setup_database, teardown_database, seed, \
+    explain, timed
+
+
+
+COMPOSITE_INDEXES = (
+    ('newsy_newsitem', ['published', 'publication_date']),
+    ('newsy_newsitem', ['publication_date', 'title']),
+    ('newsy_newsitem_sites', ['site_id', 'newsitem_id']),
+)
+
+def _list_view(**kwargs):
+    view = NewsListView()
+    view.kwargs = kwargs
+    return view.get_queryset()
+
+def access_paths():
+    return (
+        ('item list', lambda: _list_view()[:15]),
+        ('year archive', lambda: _list_view(year='2008')[:15]),
+        ('month archive', lambda: _list_view(year='2008', month='6')[:15]),
+        ('day archive', lambda: _list_view(year='2008', month='6',
+                                           day='15')[:15]),
+        ('tag list', lambda: _list_view(tag='sports')[:15]),
+        ('feed', lambda: RssNewsItemFeed().items(None)),
+        ('latest news plugin', lambda: LatestNewsPlugin(limit=5).items()),
+        ('menu archive', lambda: ArchiveEntry.objects.for_site(
+            settings.SITE_ID)),
+    )
+
+def report(title):
+    print '=' * 72
+    print title
+    print '=' * 72
+    for name, queryset in access_paths():
+        qs = queryset()
+        print '%s (%.1f ms)' % (name, timed(lambda: list(queryset())),)
+        if hasattr(qs, 'query'):
+            for line in explain(qs):
+                print '    %s' % (line,)
+        print
+
+def main(count=100000):
+    from south.db import db
+    
+    old_name = setup_database()
+    try:
+        seed(count)
+        report('With composite indexes (%d items)' % (count,))
+        for table, columns in COMPOSITE_INDEXES:
+            db.delete_index(table, columns)
+        report('Without composite indexes (%d items)' % (count,))
+    finally:
+        teardown_database(old_name)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
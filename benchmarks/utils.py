@@ -0,0 +1,116 @@
+"""
+Helpers shared by the newsy benchmarks: a throwaway test database and fast
+seeding of news items that bypasses the model signals.
+"""
+from datetime import datetime, timedelta
+from time import time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+
+from tagging.models import Tag, TaggedItem
+
+from newsy.models import NewsItem, ArchiveEntry, TagUsage, NewsItemTag, \
+    bulk_insert
+
+
+
+TAGS = ('news', 'events', 'sports', 'politics', 'science', 'culture',
+        'business', 'weather',)
+
+def setup_database():
+    """
+    Create and migrate a test database from the project settings and return
+    the name of the original database for teardown_database.
+    """
+    try:
+        from south.management.commands import patch_for_test_db_setup
+        patch_for_test_db_setup()
+    except ImportError:
+        pass
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    return old_name
+
+def teardown_database(old_name):
+    connection.creation.destroy_test_db(old_name, verbosity=0)
+
+def _chunks(rows, size=1000):
+    for start in xrange(0, len(rows), size):
+        yield rows[start:start + size]
+
+def seed(count, start=datetime(2002, 1, 1), span_days=3650):
+    """
+    Insert count news items on the current site, published every few
+    minutes across span_days from start with one in ten unpublished, and
+    build the denormalized newsy tables for them. Expects empty tables.
+    """
+    site_id = settings.SITE_ID
+    template = settings.NEWSY_TEMPLATES[0][0]
+    step = timedelta(days=span_days) / count
+    
+    items = []
+    for i in xrange(count):
+        tags = '%s %s' % (TAGS[i % len(TAGS)], TAGS[(i / 7) % len(TAGS)])
+        items.append((u'News item %d' % (i,), 'news-item-%d' % (i,),
+                      template, start + step * i, i % 10 != 0, tags, False))
+    for chunk in _chunks(items):
+        bulk_insert(NewsItem, ('title', 'slug', 'template',
+            'publication_date', 'published', 'tags', 'related_stale'), chunk)
+    
+    pks = list(NewsItem.objects.order_by('slug').values_list('pk', 'slug',
+        'publication_date', 'published', 'tags'))
+    
+    for chunk in _chunks(pks):
+        bulk_insert(NewsItem.sites.through, ('newsitem', 'site'),
+                    [(pk, site_id) for pk, slug, pub, published, tags in chunk])
+        bulk_insert(ArchiveEntry, ('site', 'news_item', 'publication_date',
+            'year', 'month', 'day', 'title', 'slug'),
+            [(site_id, pk, pub, pub.year, pub.month, pub.day, slug, slug)
+             for pk, slug, pub, published, tags in chunk if published])
+    
+    tag_ids = {}
+    for name in TAGS:
+        tag_ids[name] = Tag.objects.get_or_create(name=name)[0].pk
+    content_type = ContentType.objects.get_for_model(NewsItem)
+    tagged = []
+    for pk, slug, pub, published, tags in pks:
+        for name in set(tags.split()):
+            tagged.append((tag_ids[name], content_type.pk, pk))
+    for chunk in _chunks(tagged):
+        bulk_insert(TaggedItem, ('tag', 'content_type', 'object_id'), chunk)
+        bulk_insert(NewsItemTag, ('tag', 'news_item'),
+                    [(tag_id, pk) for tag_id, ct, pk in chunk])
+    
+    TagUsage.objects.refresh([site_id])
+
+def sql_for(queryset):
+    return queryset.query.get_compiler(queryset.db).as_sql()
+
+def explain(queryset):
+    """
+    The database's query plan for a queryset as a list of lines.
+    """
+    sql, params = sql_for(queryset)
+    if 'sqlite' in connection.settings_dict['ENGINE']:
+        sql = 'EXPLAIN QUERY PLAN ' + sql
+    else:
+        sql = 'EXPLAIN ' + sql
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return [' '.join([unicode(column) for column in row])
+            for row in cursor.fetchall()]
+
+def timed(function, repeat=5):
+    """
+    The best of repeat wall clock timings of function, in milliseconds.
+    """
+    best = None
+    for i in xrange(repeat):
+        started = time()
+        function()
+        elapsed = (time() - started) * 1000
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
@@ -18,10 +18,11 @@ from cms.models import Placeholder, CMSPlugin
 from cms.plugin_pool import plugin_pool
 from cms.utils import get_language_from_request
 from cms.utils.helpers import make_revision_with_plugins
-from cms.utils.plugins import get_placeholders
 
 from newsy.forms import NewsItemAddForm, NewsItemForm
 from newsy.models import NewsItem, NewsItemThumbnail
+from newsy.placeholders import bump_content_version, get_placeholders
+from newsy.sites import get_current_site, get_current_site_id
 
 if 'reversion' in settings.INSTALLED_APPS:
     import reversion
@@ -341,7 +342,7 @@ class NewsItemAdmin(ModelAdmin):
                 'moderator_should_approve': False,
                 'moderation_delete_request': moderation_delete_request,
                 'show_delete_translation': False,
-                'current_site_id': settings.SITE_ID,
+                'current_site_id': get_current_site_id(),
                 'language': get_language_from_request(request, obj),
                 'language_tabs': self._get_site_languages(obj),
                 'show_language_tabs': False
@@ -389,7 +390,11 @@ class NewsItemAdmin(ModelAdmin):
     def render_revision_form(self, request, obj, version, context, revert=False, recover=False):
         obj.version = version
 
-        return super(NewsItemAdmin, self).render_revision_form(request, obj, version, context, revert, recover)
+        response = super(NewsItemAdmin, self).render_revision_form(request, obj, version, context, revert, recover)
+        if request.method == 'POST' and obj.pk:
+            # the reverted plugins may be saved after the item
+            bump_content_version(obj.placeholders.values_list('pk', flat=True))
+        return response
     
     @transaction.commit_on_success
     def move_page(self, request, page_id, extra_context=None):
@@ -646,7 +651,7 @@ class NewsItemAdmin(ModelAdmin):
 
         url = instance.get_absolute_url() + attrs
 
-        site = Site.objects.get_current()
+        site = get_current_site()
 
         if not site == instance.site:
             url = "http://%s%s" % (instance.site.domain, url)
@@ -747,6 +752,7 @@ class NewsItemAdmin(ModelAdmin):
             if parent:
                 plugin.parent = parent
             plugin.save()
+            bump_content_version([placeholder.pk])
             
             if 'reversion' in settings.INSTALLED_APPS and page:
                 make_revision_with_plugins(page)
@@ -778,6 +784,7 @@ class NewsItemAdmin(ModelAdmin):
             plugins = list(placeholder.cmsplugin_set.filter(language=copy_from).order_by('tree_id', '-rght'))
             
             copy_plugins_to(plugins, placeholder, language)
+            bump_content_version([placeholder.pk])
             
             if page and "reversion" in settings.INSTALLED_APPS:
                 make_revision_with_plugins(page)
@@ -857,6 +864,7 @@ class NewsItemAdmin(ModelAdmin):
             # just pass id to plugin_admin
             response = plugin_admin.change_view(request, str(plugin_id))
         if request.method == "POST" and plugin_admin.object_successfully_changed:
+            bump_content_version([cms_plugin.placeholder_id])
             
             # if reversion is installed, save version of the page plugins
             if 'reversion' in settings.INSTALLED_APPS and page:
@@ -888,6 +896,7 @@ class NewsItemAdmin(ModelAdmin):
             pos = 0
             page = None
             success = False
+            placeholder_ids = set()
             if 'plugin_id' in request.POST:
                 plugin = CMSPlugin.objects.get(pk=int(request.POST['plugin_id']))
                 old_placeholder = plugin.placeholder
@@ -902,6 +911,7 @@ class NewsItemAdmin(ModelAdmin):
                 position = CMSPlugin.objects.filter(placeholder=placeholder).count()
                 plugin.position = position
                 plugin.save()
+                placeholder_ids.update([old_placeholder.pk, placeholder.pk])
                 success = True
             if 'ids' in request.POST:
                 for plugin_id in request.POST['ids'].split("_"):
@@ -914,10 +924,12 @@ class NewsItemAdmin(ModelAdmin):
                     if plugin.position != pos:
                         plugin.position = pos
                         plugin.save()
+                        placeholder_ids.add(plugin.placeholder_id)
                     pos += 1
                 success = True
             if not success:
                 HttpResponse(str("error"))
+            bump_content_version(placeholder_ids)
                 
             if page and 'reversion' in settings.INSTALLED_APPS:
                 make_revision_with_plugins(page)
@@ -947,6 +959,7 @@ class NewsItemAdmin(ModelAdmin):
                 page.save()
             else:
                 plugin.delete_with_public()
+            bump_content_version([placeholder.pk])
 
             plugin_name = unicode(plugin_pool.get_plugin(plugin.plugin_type).name)
             comment = _(u"%(plugin_name)s plugin at position %(position)s in %(placeholder)s was deleted.") % {'plugin_name':plugin_name, 'position':plugin.position, 'placeholder':plugin.placeholder}
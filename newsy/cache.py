@@ -0,0 +1,102 @@
+from hashlib import md5
+from logging import getLogger
+from threading import local
+from time import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.dispatch import receiver
+from django.template import Template
+from django.utils.encoding import smart_str
+
+
+
+log = getLogger('newsy.cache')
+
+CACHE_PREFIX = getattr(settings, 'NEWSY_CACHE_PREFIX', 'newsy')
+CACHE_TIMEOUT = getattr(settings, 'NEWSY_CACHE_TIMEOUT', 60 * 60)
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+_pending = local()
+
+def make_key(*parts):
+    """
+    Build a cache key from the given parts. Keys that would be too long or
+    contain characters memcached does not accept are hashed.
+    """
+    key = ':'.join([smart_str(part) for part in (CACHE_PREFIX,) + parts])
+    if len(key) > 200 or [c for c in key if ord(c) < 33 or ord(c) > 126]:
+        key = '%s:%s' % (CACHE_PREFIX, md5(key).hexdigest(),)
+    return key
+
+def _generation_key(site_id, namespace):
+    return make_key('generation', namespace, site_id)
+
+def get_generation(site_id, namespace='news'):
+    """
+    Get the current generation for the site. Cached values that include the
+    generation in their key are invalidated by bump_generation.
+    """
+    key = _generation_key(site_id, namespace)
+    generation = cache.get(key)
+    if generation is None:
+        # Start from the clock so a generation lost from the cache is never
+        # reused for stale entries.
+        generation = int(time() * 1000)
+        cache.add(key, generation, GENERATION_TIMEOUT)
+        generation = cache.get(key, generation)
+    return generation
+
+def bump_generation(site_ids, namespace='news'):
+    for site_id in set(site_ids):
+        log.debug('bump_generation(site_id=%s, namespace=%s)' % (site_id,
+                                                                 namespace,))
+        key = _generation_key(site_id, namespace)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, int(time() * 1000), GENERATION_TIMEOUT)
+
+def bump_generation_on_commit(site_ids, namespace='news'):
+    """
+    Bump the generation now and again when the current request has finished
+    and its transaction is committed. Values cached in between from the
+    uncommitted data are replaced then, instead of staying stale for
+    NEWSY_CACHE_TIMEOUT.
+    """
+    site_ids = set(site_ids)
+    bump_generation(site_ids, namespace)
+    pending = getattr(_pending, 'generations', None)
+    if pending is None:
+        pending = _pending.generations = {}
+    pending.setdefault(namespace, set()).update(site_ids)
+
+@receiver(request_finished)
+def bump_pending_generations(**kwargs):
+    pending = getattr(_pending, 'generations', None)
+    _pending.generations = None
+    for namespace, site_ids in (pending or {}).items():
+        bump_generation(site_ids, namespace)
+
+class CachedTemplate(Template):
+    """
+    Wraps a compiled template and caches its output under the cache key found
+    in the context variable named by key_variable. Without a key in the
+    context the template is rendered as usual.
+    """
+    def __init__(self, template, timeout, key_variable='fragment_cache_key'):
+        self.template = template
+        self.name = getattr(template, 'name', None)
+        self.timeout = timeout
+        self.key_variable = key_variable
+
+    def render(self, context):
+        key = context.get(self.key_variable, None)
+        if not key:
+            return self.template.render(context)
+        content = cache.get(key)
+        if content is None:
+            content = self.template.render(context)
+            cache.set(key, content, self.timeout)
+        return content
@@ -5,10 +5,10 @@ from django.template.loader import select_template
 
 from cms.plugin_base import CMSPluginBase
 from cms.plugin_pool import plugin_pool
+from cms.utils import get_language_from_request
 
-from tagging.models import TaggedItem, Tag
-
-from newsy.models import LatestNewsPlugin, NewsItem
+from newsy.models import LATEST_FRAGMENT_CACHE_TIMEOUT, LatestNewsPlugin, \
+    prefetch_tags
 
 
 
@@ -20,10 +20,27 @@ class CMSLatestNewsPlugin(CMSPluginBase):
     render_template = "cms/plugins/newsy/latest.html"
     
     def render(self, context, instance, placeholder):
+        """
+        With the fragment cache enabled the items are only loaded when the
+        template is actually rendered, on a cache miss.
+        """
         log.debug('CMSLatestNewsPlugin.render(instance=%s)' % 
                   (unicode(instance),))
-        context.update({
-            'object': instance})
+        if LATEST_FRAGMENT_CACHE_TIMEOUT and 'request' in context:
+            loaded = []
+            def items():
+                if not loaded:
+                    loaded.append(prefetch_tags(instance.items()))
+                return loaded[0]
+            context.update({
+                'object': instance,
+                'items': items,
+                'newsy_fragment_key': instance.get_fragment_key(
+                    get_language_from_request(context['request']))})
+        else:
+            context.update({
+                'object': instance,
+                'items': prefetch_tags(instance.items())})
         return context
 
 plugin_pool.register_plugin(CMSLatestNewsPlugin)
@@ -1,36 +1,257 @@
+from StringIO import StringIO
+from calendar import timegm
 from datetime import date
+from hashlib import md5
+from urlparse import urlsplit, urlunsplit
 
-from django.contrib.sites.models import Site
+from django.conf import settings
+from django.contrib.sites.models import get_current_site as get_django_site
 from django.contrib.syndication.views import Feed
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.template.context import RequestContext
+from django.utils.feedgenerator import Atom1Feed, Rss201rev2Feed
+from django.utils.http import http_date, parse_http_date_safe
+from django.utils.xmlutils import SimplerXMLGenerator
 
-from tagging.models import TaggedItem, Tag
+from cms.utils import get_language_from_request
 
-from newsy.models import NewsItem
+from newsy.cache import CACHE_TIMEOUT, get_generation, make_key
+from newsy.models import NewsItem, filter_by_tags, prefetch_tags
+from newsy.placeholders import get_content_generation, \
+    render_newsitem_content
+from newsy.sites import get_current_site, get_current_site_id, pinned_site
 
 
-_current_site = Site.objects.get_current
+FEED_LENGTH = getattr(settings, 'NEWSY_FEED_LENGTH', 5)
+FEED_LENGTHS = getattr(settings, 'NEWSY_FEED_LENGTHS', {})
+FEED_FULL_CONTENT = getattr(settings, 'NEWSY_FEED_FULL_CONTENT', False)
+FEED_STREAM_THRESHOLD = getattr(settings, 'NEWSY_FEED_STREAM_THRESHOLD', 100)
+
+class StreamingFeedMixin(object):
+    """
+    Feed generator mixin that can write the feed one item at a time. When a
+    content_renderer is set, the content of each item is rendered from its
+    news item only while that item is being written.
+    """
+    content_renderer = None
+    _latest_post_date = None
+    
+    def render_content(self, item):
+        if self.content_renderer is not None and \
+                item.get('newsy_item', None) is not None:
+            return self.content_renderer(item['newsy_item'])
+        return None
+    
+    def add_item_elements(self, handler, item):
+        content = self.render_content(item)
+        if content is not None:
+            item = dict(item, description=content)
+        super(StreamingFeedMixin, self).add_item_elements(handler, item)
+    
+    def latest_post_date(self):
+        if self._latest_post_date is not None:
+            return self._latest_post_date
+        return super(StreamingFeedMixin, self).latest_post_date()
+    
+    def stream(self, encoding):
+        """
+        Generate the feed document in chunks of the feed head, one chunk per
+        item and the closing tags. The chunks are written for the current
+        site of the request, which has ended by the time they are generated.
+        """
+        return self._stream(encoding, get_current_site())
+    
+    def _stream(self, encoding, site):
+        items = self.items
+        try:
+            # the head is written without the items, but dated by them
+            self._latest_post_date = self.latest_post_date()
+            self.items = []
+            outfile = StringIO()
+            with pinned_site(site):
+                self.write(outfile, encoding)
+            document = outfile.getvalue()
+            split = document.rindex(self.stream_closing_tag)
+            yield document[:split]
+            
+            for item in items:
+                self.items = [item]
+                outfile = StringIO()
+                with pinned_site(site):
+                    self.write_items(SimplerXMLGenerator(outfile, encoding))
+                yield outfile.getvalue()
+            
+            yield document[split:]
+        finally:
+            self.items = items
+            self._latest_post_date = None
+
+class StreamingRssFeed(StreamingFeedMixin, Rss201rev2Feed):
+    stream_closing_tag = '</channel>'
+
+class StreamingAtomFeed(StreamingFeedMixin, Atom1Feed):
+    stream_closing_tag = '</feed>'
+    
+    def add_item_elements(self, handler, item):
+        """
+        Atom keeps the description as the summary and puts the rendered
+        content in a content element.
+        """
+        content = self.render_content(item)
+        Atom1Feed.add_item_elements(self, handler, item)
+        if content is not None:
+            handler.addQuickElement(u'content', content, {u'type': u'html'})
+
+def _replace_domain(url, old, new):
+    if not url:
+        return url
+    parts = urlsplit(url)
+    if parts.netloc != old:
+        return url
+    return urlunsplit((parts.scheme, new,) + tuple(parts[2:]))
+
+def _with_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+def _not_modified(request, etag, last_modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+    if if_none_match:
+        return etag in [e.strip() for e in if_none_match.split(',')] or \
+            if_none_match.strip() == '*'
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE', None)
+    if if_modified_since:
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        return if_modified_since is not None and \
+            if_modified_since >= last_modified
+    return False
 
 class RssNewsItemFeed(Feed):
+    feed_type = StreamingRssFeed
+    feed_url_name = 'newsy-rss-feed'
+    tag_feed_url_name = 'newsy-rss-tag-feed'
+    full_content = FEED_FULL_CONTENT
+    
+    def __init__(self, full_content=None):
+        if full_content is not None:
+            self.full_content = full_content
+    
+    def __call__(self, request, *args, **kwargs):
+        """
+        Serve the feed from the cache with ETag and Last-Modified headers.
+        The cache key includes the site's news generation, so the cached feed
+        is replaced as soon as a news item is published or edited. Feeds
+        longer than NEWSY_FEED_STREAM_THRESHOLD are streamed instead of
+        cached. Full content feeds are rendered in the request language and
+        cached per language and content generation.
+        """
+        try:
+            obj = self.get_object(request, *args, **kwargs)
+        except ObjectDoesNotExist:
+            raise Http404('Feed object does not exist.')
+
+        site_id = get_current_site_id()
+        content_parts = ()
+        if self.full_content:
+            content_parts = (get_language_from_request(request),
+                             get_content_generation(),)
+        key = make_key('feed', self.__class__.__name__, self.full_content,
+                       site_id, get_generation(site_id), obj, *content_parts)
+        meta_key = make_key('feed-meta', key)
+        etag = '"%s"' % (md5(key).hexdigest(),)
+
+        known_modified = cache.get(meta_key)
+        if known_modified is not None and \
+                _not_modified(request, etag, known_modified):
+            return _with_validators(HttpResponseNotModified(), etag,
+                                    known_modified)
+
+        if self.get_length(obj) > FEED_STREAM_THRESHOLD:
+            feedgen = self.get_feed(obj, request)
+            last_modified = timegm(feedgen.latest_post_date().utctimetuple())
+            if known_modified is None:
+                cache.set(meta_key, last_modified, CACHE_TIMEOUT)
+            if _not_modified(request, etag, last_modified):
+                return _with_validators(HttpResponseNotModified(), etag,
+                                        last_modified)
+            return _with_validators(HttpResponse(feedgen.stream('utf-8'),
+                mimetype=feedgen.mime_type), etag, last_modified)
+
+        cached = cache.get(key)
+        if cached is None:
+            feedgen = self.get_feed(obj, request)
+            cached = (feedgen.writeString('utf-8'), feedgen.mime_type,
+                      timegm(feedgen.latest_post_date().utctimetuple()),)
+            cache.set(key, cached, CACHE_TIMEOUT)
+        content, mime_type, last_modified = cached
+        if known_modified is None:
+            cache.set(meta_key, last_modified, CACHE_TIMEOUT)
+
+        if _not_modified(request, etag, last_modified):
+            return _with_validators(HttpResponseNotModified(), etag,
+                                    last_modified)
+
+        return _with_validators(HttpResponse(content, mimetype=mime_type),
+                                etag, last_modified)
+    
+    def get_feed(self, obj, request):
+        """
+        Django builds the feed links on its own current site, the SITE_ID
+        site, so they are moved to the domain of the newsy current site.
+        """
+        feedgen = super(RssNewsItemFeed, self).get_feed(obj, request)
+        django_domain = get_django_site(request).domain
+        domain = get_current_site().domain
+        if django_domain != domain:
+            for key in ('link', 'feed_url',):
+                feedgen.feed[key] = _replace_domain(feedgen.feed[key],
+                                                    django_domain, domain)
+            for item in feedgen.items:
+                for key in ('link', 'unique_id',):
+                    item[key] = _replace_domain(item[key], django_domain,
+                                                domain)
+        if self.full_content:
+            context = RequestContext(request)
+            context['lang'] = get_language_from_request(request)
+            feedgen.content_renderer = lambda item: render_newsitem_content(
+                item, context)
+        return feedgen
+    
+    def get_length(self, obj):
+        """
+        The number of items in the feed, looked up in NEWSY_FEED_LENGTHS by
+        (site id, tag), tag and site id before falling back to
+        NEWSY_FEED_LENGTH.
+        """
+        site_id = get_current_site_id()
+        for key in ((site_id, obj), obj, site_id):
+            if key is not None and key in FEED_LENGTHS:
+                return FEED_LENGTHS[key]
+        return FEED_LENGTH
+    
     def title(self, obj=None):
         if not obj:
-            return u'Latest news for %s' % (_current_site().name,)
+            return u'Latest news for %s' % (get_current_site().name,)
         else:
             return u'Latest news for %s at %s' % (str(obj),
-                                                  _current_site().name,)
+                                                  get_current_site().name,)
     
     def link(self, obj=None):
         if not obj:
-            return reverse('newsy-rss-feed')
+            return reverse(self.feed_url_name)
         else:
-            return reverse('newsy-rss-tag-feed', kwargs={'tag': str(obj)})
+            return reverse(self.tag_feed_url_name, kwargs={'tag': str(obj)})
     
     def description(self, obj=None):
         return self.title(obj)
     
     def feed_copyright(self):
         return u'Copyright (c) %d, %s' % (date.today().year,
-                                          _current_site().name,)
+                                          get_current_site().name,)
     
     def get_object(self, request, *args, **kwargs):
         return kwargs.get('tag', None)
@@ -44,8 +265,8 @@ class RssNewsItemFeed(Feed):
         qs = NewsItem.site_objects.filter(published=True)
         
         if obj:
-            return TaggedItem.objects.get_by_model(qs, [obj])[:5]
-        return qs[:5]
+            qs = filter_by_tags(qs, [obj])
+        return prefetch_tags(qs[:self.get_length(obj)])
     
     def item_title(self, item):
         return item.title
@@ -53,6 +274,11 @@ class RssNewsItemFeed(Feed):
     def item_description(self, item):
         return item.description
     
+    def item_extra_kwargs(self, item):
+        if self.full_content:
+            return {'newsy_item': item}
+        return {}
+    
     def item_link(self, item):
         return item.get_absolute_url()
     
@@ -60,5 +286,12 @@ class RssNewsItemFeed(Feed):
         return item.publication_date
     
     def item_categories(self, item):
-        return map(lambda t: t.name,
-                   Tag.objects.get_for_object(item))
+        return map(lambda t: t.name, item.get_tags())
+
+class AtomNewsItemFeed(RssNewsItemFeed):
+    feed_type = StreamingAtomFeed
+    feed_url_name = 'newsy-atom-feed'
+    tag_feed_url_name = 'newsy-atom-tag-feed'
+    
+    def subtitle(self, obj=None):
+        return self.description(obj)
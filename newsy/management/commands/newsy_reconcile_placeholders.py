@@ -0,0 +1,41 @@
+from logging import getLogger
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from newsy.models import NewsItem, create_missing_placeholders
+
+
+
+log = getLogger('newsy.management.commands.newsy_reconcile_placeholders')
+
+class Command(BaseCommand):
+    help = ('Create the placeholders missing for the slots in the templates '
+            'of news items, e.g. after a slot was added to a template.')
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            default=500, help='Number of news items loaded at a time.'),
+        make_option('--start-id', type='int', dest='start_id', default=0,
+            help='Resume with the news items from this id on.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        chunk_size = options['chunk_size']
+        start_id = options['start_id']
+
+        checked = created = 0
+        while True:
+            items = list(NewsItem.objects.filter(pk__gte=start_id).order_by(
+                'pk')[:chunk_size])
+            if not items:
+                break
+            created += create_missing_placeholders(items)
+            checked += len(items)
+            start_id = items[-1].pk + 1
+            log.debug('Checked items %d to %d, created %d placeholders' % (
+                      items[0].pk, items[-1].pk, created,))
+            if verbosity > 0:
+                self.stdout.write('Checked %d items, created %d placeholders '
+                                  '(resume with --start-id=%d)\n' % (checked,
+                                  created, start_id,))
@@ -0,0 +1,41 @@
+from logging import getLogger
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from newsy.models import NewsItem, RelatedNewsItem
+
+
+
+log = getLogger('newsy.management.commands.newsy_refresh_related')
+
+class Command(BaseCommand):
+    help = 'Recompute the related news of news items flagged as stale.'
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+            help='Recompute the related news of every news item.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            default=500, help='Number of news items loaded at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        chunk_size = options['chunk_size']
+
+        if options['all']:
+            NewsItem.objects.update(related_stale=True)
+
+        done = 0
+        while True:
+            pks = list(NewsItem.objects.filter(related_stale=True).order_by(
+                'pk').values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                break
+            for item in NewsItem.objects.filter(pk__in=pks):
+                RelatedNewsItem.objects.refresh(item)
+            done += len(pks)
+            log.debug('Refreshed related news for items %d to %d' % (
+                      pks[0], pks[-1],))
+            if verbosity > 0:
+                self.stdout.write('Refreshed related news for %d items\n' % (
+                                  done,))
@@ -1,15 +1,18 @@
 import re
+from datetime import date
 
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 
 from menus.base import NavigationNode, Modifier
 from menus.menu_pool import menu_pool
 from django.utils.translation import ugettext_lazy as _
 from cms.menu_bases import CMSAttachMenu
+from cms.utils import get_language_from_request
 
-from tagging.models import Tag
-
-from newsy.models import NewsItem
+from newsy.cache import CACHE_TIMEOUT, get_generation, make_key
+from newsy.models import ArchiveEntry, TagUsage
+from newsy.sites import get_current_site_id
 
 
 
@@ -17,42 +20,64 @@ class NewsyMenu(CMSAttachMenu):
     name = _('News Menu')
 
     def get_nodes(self, request):
-        qs = NewsItem.site_objects.filter(published=True)
+        site_id = get_current_site_id()
+        key = make_key('menu', site_id, get_generation(site_id),
+                       get_language_from_request(request))
+        nodes = cache.get(key)
+        if nodes is None:
+            nodes = self._build_nodes(request)
+            cache.set(key, nodes, CACHE_TIMEOUT)
+        return nodes
+
+    def _build_nodes(self, request):
         nodes = []
         nodes.append(NavigationNode(_('Tags'), reverse('tags-view'), 'tags'))
 
-        tags = Tag.objects.usage_for_queryset(qs, counts=True)
-        tags.sort(key=lambda t:t.count, reverse=True)
+        tags = TagUsage.objects.tags_for_site(get_current_site_id(),
+                                              order_by=('-count', 'tag__name'))
         for tag in tags:
             nodes.append(NavigationNode(_(tag.name), reverse('tag-view',
                 kwargs={'tag':tag.name}), 'tag_%s' % (tag.name,), 'tags'))
 
-        for year in qs.dates('publication_date', 'year', order='DESC'):
-            nodes.append(NavigationNode(year.year, reverse('archive-view', 
-                kwargs={'year': year.year}), year.strftime('year_%Y')))
-            for month in qs.filter(publication_date__year=year.year).dates('publication_date',
-                            'month', order='ASC'):
-                nodes.append(NavigationNode(month.strftime('%B'),
-                        reverse('month-view', kwargs={'year': month.year,
-                            'month': month.month}),
-                            month.strftime('year_%Y_month_%m'),
-                            month.strftime('year_%Y')))
-
-                for day in qs.filter(publication_date__year=month.year,
-                        publication_date__month=month.month).dates('publication_date',
-                                'day', order='ASC'):
-                    nodes.append(NavigationNode(day.day, reverse('date-view',
-                        kwargs={'year': day.year, 'month': day.month, 'day':
-                            day.day}), day.strftime('year_%Y_month_%m_day_%d'),
-                        day.strftime('year_%Y_month_%m')))
-
-        for news_item in qs:
-            pub = news_item.publication_date
-            nodes.append(NavigationNode(news_item.get_short_title(),
-                    reverse('published-item-view', kwargs={'year': pub.year,
-                        'month': pub.month, 'day': pub.day, 'slug':
-                        news_item.slug}), 'news_item_%d' % (news_item.pk,), 
-                    pub.strftime('year_%Y_month_%m_day_%d')))
+        entries = list(ArchiveEntry.objects.for_site(
+            get_current_site_id()).values_list('news_item', 'title',
+                'slug', 'year', 'month', 'day'))
+
+        counts = {}
+        months = {}
+        days = {}
+        for item_id, title, slug, year, month, day in entries:
+            for key in ((year,), (year, month), (year, month, day)):
+                counts[key] = counts.get(key, 0) + 1
+            months.setdefault(year, set()).add(month)
+            days.setdefault((year, month), set()).add(day)
+
+        for year in sorted(months, reverse=True):
+            nodes.append(NavigationNode(year, reverse('archive-view',
+                kwargs={'year': year}), 'year_%04d' % (year,),
+                attr={'count': counts[(year,)]}))
+            for month in sorted(months[year]):
+                nodes.append(NavigationNode(
+                        date(year, month, 1).strftime('%B'),
+                        reverse('month-view', kwargs={'year': year,
+                            'month': month}),
+                        'year_%04d_month_%02d' % (year, month,),
+                        'year_%04d' % (year,),
+                        attr={'count': counts[(year, month)]}))
+
+                for day in sorted(days[(year, month)]):
+                    nodes.append(NavigationNode(day, reverse('date-view',
+                        kwargs={'year': year, 'month': month, 'day': day}),
+                        'year_%04d_month_%02d_day_%02d' % (year, month, day,),
+                        'year_%04d_month_%02d' % (year, month,),
+                        attr={'count': counts[(year, month, day)]}))
+
+        for item_id, title, slug, year, month, day in entries:
+            nodes.append(NavigationNode(title,
+                    reverse('published-item-view', kwargs={'year': year,
+                        'month': month, 'day': day, 'slug': slug}),
+                    'news_item_%d' % (item_id,),
+                    'year_%04d_month_%02d_day_%02d' % (year, month, day,)))
 
         return nodes
 
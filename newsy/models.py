@@ -2,9 +2,12 @@ from datetime import date
 from logging import getLogger
 
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
-from django.contrib.sites.managers import CurrentSiteManager
-from django.db import models
+from django.core.cache import cache
+from django.core.urlresolvers import NoReverseMatch
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Count
 from django.template.loader import select_template
 from django.utils.translation import ugettext_lazy as _
 
@@ -14,6 +17,11 @@ from photologue.models import ImageModel
 
 from tagging.fields import TagField as BaseTagField
 from tagging.models import TaggedItem, Tag
+from tagging.utils import parse_tag_input
+
+from newsy.cache import CACHE_TIMEOUT, CachedTemplate, get_generation, \
+    make_key
+from newsy.sites import CurrentSiteManager, get_current_site_id
 
 
 
@@ -59,6 +67,10 @@ class NewsItem(models.Model):
     sites = models.ManyToManyField(Site)
     placeholders = models.ManyToManyField(Placeholder, editable=False)
     tags = TagField()
+    tag_set = models.ManyToManyField(Tag, through='NewsItemTag',
+                                     related_name='news_items', editable=False)
+    related_stale = models.BooleanField(default=True, db_index=True,
+                                        editable=False)
     
     moderator_state = 0
     
@@ -99,33 +111,85 @@ class NewsItem(models.Model):
             return date.today().replace(day=1)
     
     def get_related(self, max=5):
-        return TaggedItem.objects.get_related(self,
-                   NewsItem.site_objects.filter(published=True),
-                   num=max)
+        """
+        Published news items on the current site related to this one, read
+        from the precomputed RelatedNewsItem table.
+        """
+        return NewsItem.site_objects.filter(published=True,
+            related_to_entries__news_item=self).order_by(
+                '-related_to_entries__score')[:max]
     
-    def get_next_published(self):
+    def get_neighbours(self):
+        """
+        The previous and next published news items on the current site as a
+        (previous, next) tuple. Both are loaded with one query and cached
+        until the site's news generation changes.
+        """
         if not self.publication_date or not self.published:
-            return None
+            return (None, None)
         
-        try:
-            return NewsItem.site_objects.filter(
-                published=True,
-                publication_date__gt=self.publication_date).order_by(
-                    'publication_date')[0]
-        except:
-            return None
+        if hasattr(self, '_neighbours_cache'):
+            return self._neighbours_cache
+        
+        site_id = get_current_site_id()
+        key = make_key('neighbours', site_id, get_generation(site_id),
+                       self.pk)
+        neighbours = cache.get(key)
+        if neighbours is None:
+            neighbours = self._load_neighbours(site_id)
+            cache.set(key, neighbours, CACHE_TIMEOUT)
+        
+        self._neighbours_cache = neighbours
+        return neighbours
     
-    def get_previous_published(self):
-        if not self.publication_date or not self.published:
-            return None
+    def _load_neighbours(self, site_id):
+        qn = connection.ops.quote_name
+        sites = NewsItem.sites
+        neighbour_sql = ('SELECT n.* FROM %(table)s n '
+            'INNER JOIN %(sites)s s ON s.%(item_id)s = n.%(pk)s '
+            'WHERE s.%(site_id)s = %%s AND n.%(published)s = %%s '
+            'AND n.%(date)s %(op)s %%s '
+            'ORDER BY n.%(date)s %(order)s LIMIT 1')
+        names = {'table': qn(self._meta.db_table),
+                 'sites': qn(sites.through._meta.db_table),
+                 'item_id': qn(sites.field.m2m_column_name()),
+                 'site_id': qn(sites.field.m2m_reverse_name()),
+                 'pk': qn(self._meta.pk.column),
+                 'published': qn('published'),
+                 'date': qn('publication_date')}
+        sql = 'SELECT * FROM (%s) previous UNION ALL SELECT * FROM (%s) next' % (
+            neighbour_sql % dict(names, op='<', order='DESC'),
+            neighbour_sql % dict(names, op='>', order='ASC'),)
+        params = [site_id, True, self.publication_date] * 2
         
-        try:
-            return NewsItem.site_objects.filter(
-                published=True,
-                publication_date__lt=self.publication_date).order_by(
-                    '-publication_date')[0]
-        except:
-            return None
+        previous_item = next_item = None
+        for item in NewsItem.objects.raw(sql, params):
+            if item.publication_date < self.publication_date:
+                previous_item = item
+            else:
+                next_item = item
+        return (previous_item, next_item)
+    
+    def get_next_published(self):
+        return self.get_neighbours()[1]
+    
+    def get_previous_published(self):
+        return self.get_neighbours()[0]
+    
+    def get_tags(self):
+        """
+        The tags for this news item, using the ones attached by prefetch_tags
+        when available.
+        """
+        if hasattr(self, '_prefetched_tags'):
+            return self._prefetched_tags
+        return self.tag_set.order_by('name')
+    
+    def get_tag_ids(self):
+        if not self.pk:
+            return []
+        return list(NewsItemTag.objects.filter(news_item=self).values_list(
+            'tag', flat=True))
     
     def get_cached_ancestors(self, ascending=True):
         return []
@@ -146,19 +210,8 @@ class NewsItem(models.Model):
         """
         Rescan and if necessary create placeholders in the current template.
         """
-        # inline import to prevent circular imports
         log.debug('NewsItem.rescan_placeholders(%s)' % (unicode(self),))
-        from cms.utils.plugins import get_placeholders
-        placeholders = get_placeholders(self.get_template())
-        found = {}
-        for placeholder in self.placeholders.all():
-            if placeholder.slot in placeholders:
-                found[placeholder.slot] = placeholder
-        for placeholder_name in placeholders:
-            if not placeholder_name in found:
-                placeholder = Placeholder.objects.create(slot=placeholder_name)
-                self.placeholders.add(placeholder)
-                found[placeholder_name] = placeholder
+        create_missing_placeholders([self])
     
     def has_change_permission(self, request):
         opts = self._meta
@@ -221,6 +274,398 @@ class NewsItem(models.Model):
                 
         return getattr(self, att_name)
 
+def prefetch_tags(items):
+    """
+    Load the tags for a list of news items with a single query and attach them
+    to the items for NewsItem.get_tags. Returns the items as a list.
+    """
+    items = list(items)
+    if not items:
+        return items
+
+    tags = dict([(item.pk, []) for item in items])
+    entries = NewsItemTag.objects.filter(news_item__in=tags.keys()
+        ).select_related('tag').order_by('tag__name')
+    for entry in entries:
+        tags[entry.news_item_id].append(entry.tag)
+
+    for item in items:
+        item._prefetched_tags = tags[item.pk]
+    return items
+
+def filter_by_tags(queryset, names, match_all=True):
+    """
+    Limit a news item queryset to the items tagged with all or any of the
+    tag names, joining the NewsItemTag table.
+    """
+    if not match_all:
+        return queryset.filter(tag_set__name__in=names).distinct()
+    for name in names:
+        queryset = queryset.filter(tag_set__name=name)
+    return queryset
+
+def bulk_insert(model, field_names, rows):
+    """
+    Insert rows of field values for a model, using bulk_create where Django
+    provides it and a single executemany otherwise. Related fields take
+    primary key values.
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    
+    fields = [model._meta.get_field(name) for name in field_names]
+    if hasattr(model.objects, 'bulk_create'):
+        attnames = [field.attname for field in fields]
+        model.objects.bulk_create([model(**dict(zip(attnames, row)))
+                                   for row in rows])
+        return
+    
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(model._meta.db_table),
+        ', '.join([qn(field.column) for field in fields]),
+        ', '.join(['%s'] * len(fields)),)
+    connection.cursor().executemany(sql, rows)
+    transaction.commit_unless_managed()
+
+def create_missing_placeholders(items):
+    """
+    Create the placeholders missing for the slots in the templates of the
+    news items. The existing placeholders of all the items are read with one
+    query and the new ones linked with one insert; the placeholders
+    themselves are bulk created where the database returns their ids and
+    created one by one otherwise. Returns the number created.
+    """
+    # inline import to prevent circular imports
+    from newsy.placeholders import get_placeholders
+    items = list(items)
+    if not items:
+        return 0
+    
+    through = NewsItem.placeholders.through
+    found = set(through.objects.filter(
+        newsitem__in=[item.pk for item in items]).values_list(
+            'newsitem', 'placeholder__slot'))
+    missing = []
+    for item in items:
+        for slot in get_placeholders(item.get_template()):
+            if (item.pk, slot) not in found:
+                missing.append((item.pk, Placeholder(slot=slot)))
+    if not missing:
+        return 0
+    log.debug('create_missing_placeholders: %d missing' % (len(missing),))
+    
+    placeholders = [placeholder for pk, placeholder in missing]
+    if getattr(connection.features, 'can_return_ids_from_bulk_insert', False):
+        Placeholder.objects.bulk_create(placeholders)
+    else:
+        for placeholder in placeholders:
+            placeholder.save()
+    bulk_insert(through, ('newsitem', 'placeholder'),
+                [(pk, placeholder.pk) for pk, placeholder in missing])
+    return len(missing)
+
+class ArchiveEntryManager(models.Manager):
+    def update_for_item(self, item):
+        """
+        Replace the archive entries for a news item with one entry for every
+        site it is published on.
+        """
+        log.debug('ArchiveEntryManager.update_for_item(%s)' % (unicode(item),))
+        self.filter(news_item=item).delete()
+
+        if not item.published or not item.publication_date:
+            return
+
+        pub = item.publication_date
+        for site_id in item.sites.values_list('pk', flat=True):
+            self.create(site_id=site_id, news_item=item, publication_date=pub,
+                        year=pub.year, month=pub.month, day=pub.day,
+                        title=item.get_short_title(), slug=item.slug)
+
+    def for_site(self, site):
+        return self.filter(site=site).order_by('-publication_date', 'title')
+
+class ArchiveEntry(models.Model):
+    """
+    Denormalized archive index of published news items, one row per item and
+    site, maintained by the receivers in newsy.signals.
+    """
+    site = models.ForeignKey(Site)
+    news_item = models.ForeignKey(NewsItem, related_name='archive_entries',
+                                  on_delete=models.CASCADE)
+    publication_date = models.DateTimeField()
+    year = models.PositiveSmallIntegerField()
+    month = models.PositiveSmallIntegerField()
+    day = models.PositiveSmallIntegerField()
+    title = models.CharField(max_length=255)
+    slug = models.SlugField(max_length=255, db_index=False)
+
+    objects = ArchiveEntryManager()
+
+    class Meta:
+        ordering = ['-publication_date', 'title']
+        unique_together = (('site', 'news_item'),)
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.title, self.publication_date,)
+
+class TagUsageManager(models.Manager):
+    def refresh(self, site_ids, tag_ids=None):
+        """
+        Recount how many published news items use each tag on the given
+        sites. Without tag_ids every tag used on the sites is recounted.
+        Rows are updated in place, so concurrent refreshes of the same tag
+        do not collide on the unique (site, tag) pair.
+        """
+        log.debug('TagUsageManager.refresh(site_ids=%s, tag_ids=%s)' % (
+                  repr(site_ids), repr(tag_ids),))
+        if tag_ids is not None:
+            tag_ids = list(tag_ids)
+            if not tag_ids:
+                return
+        for site_id in set(site_ids):
+            tagged = NewsItemTag.objects.filter(news_item__published=True,
+                                                news_item__sites=site_id)
+            stale = self.filter(site=site_id)
+            if tag_ids is not None:
+                tagged = tagged.filter(tag__in=tag_ids)
+                stale = stale.filter(tag__in=tag_ids)
+            counts = dict(tagged.values_list('tag').annotate(Count('pk')))
+            existing = dict(stale.values_list('tag', 'count'))
+            unused = [tag_id for tag_id in existing if tag_id not in counts]
+            if unused:
+                stale.filter(tag__in=unused).delete()
+            for tag_id, count in counts.items():
+                if tag_id in existing:
+                    if existing[tag_id] != count:
+                        self.filter(site=site_id, tag=tag_id).update(
+                            count=count)
+                else:
+                    self._create_or_update(site_id, tag_id, count)
+
+    def _create_or_update(self, site_id, tag_id, count):
+        sid = transaction.savepoint()
+        try:
+            self.create(site_id=site_id, tag_id=tag_id, count=count)
+        except IntegrityError:
+            # another save created the row since it was looked up
+            transaction.savepoint_rollback(sid)
+            self.filter(site=site_id, tag=tag_id).update(count=count)
+        else:
+            transaction.savepoint_commit(sid)
+
+    def tags_for_site(self, site_id, order_by=('tag__name',)):
+        """
+        The tags used by published news items on the site, each annotated
+        with a count attribute like Tag.objects.usage_for_queryset returns.
+        """
+        tags = []
+        for usage in self.filter(site=site_id).select_related('tag').order_by(
+                *order_by):
+            usage.tag.count = usage.count
+            tags.append(usage.tag)
+        return tags
+
+class TagUsage(models.Model):
+    """
+    Number of published news items using a tag on a site, maintained by the
+    receivers in newsy.signals.
+    """
+    site = models.ForeignKey(Site)
+    tag = models.ForeignKey(Tag, related_name='newsy_usage')
+    count = models.PositiveIntegerField(default=0)
+
+    objects = TagUsageManager()
+
+    class Meta:
+        unique_together = (('site', 'tag'),)
+
+    def __unicode__(self):
+        return u'%s (%d)' % (self.tag, self.count,)
+
+class NewsItemTagManager(models.Manager):
+    def sync_item(self, item):
+        """
+        Make the item's rows match the tags django-tagging holds for it.
+        """
+        log.debug('NewsItemTagManager.sync_item(%s)' % (unicode(item),))
+        tag_ids = set(TaggedItem.objects.filter(
+            content_type=ContentType.objects.get_for_model(item),
+            object_id=item.pk).values_list('tag', flat=True))
+        current = set(self.filter(news_item=item).values_list('tag',
+                                                               flat=True))
+        if current - tag_ids:
+            self.filter(news_item=item, tag__in=list(current - tag_ids)).delete()
+        bulk_insert(self.model, ('news_item', 'tag'),
+                    [(item.pk, tag_id) for tag_id in tag_ids - current])
+
+class NewsItemTag(models.Model):
+    """
+    Through table of NewsItem.tag_set, mirroring the generic TaggedItem rows
+    of django-tagging for direct joins between news items and tags, and
+    maintained by the receivers in newsy.signals.
+    """
+    news_item = models.ForeignKey(NewsItem, related_name='tag_entries',
+                                  on_delete=models.CASCADE)
+    tag = models.ForeignKey(Tag, related_name='newsitem_entries',
+                            on_delete=models.CASCADE)
+
+    objects = NewsItemTagManager()
+
+    class Meta:
+        db_table = 'newsy_newsitem_tag'
+        unique_together = (('news_item', 'tag'),)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.news_item_id, self.tag_id,)
+
+RELATED_ITEMS = getattr(settings, 'NEWSY_RELATED_ITEMS', 10)
+RELATED_RECENCY_DAYS = getattr(settings, 'NEWSY_RELATED_RECENCY_DAYS', 30)
+
+class RelatedNewsItemManager(models.Manager):
+    def refresh(self, item):
+        """
+        Recompute the related news for an item. Each published item sharing
+        a tag scores one point per shared tag plus up to one point for being
+        published close to the item, and the best NEWSY_RELATED_ITEMS are
+        kept. Since the recency point never outweighs a shared tag, the best
+        items are among the NEWSY_RELATED_ITEMS with the most shared tags
+        and the closest dates on either side of the item, so only those are
+        loaded.
+        """
+        log.debug('RelatedNewsItemManager.refresh(%s)' % (unicode(item),))
+        self.filter(news_item=item).delete()
+        NewsItem.objects.filter(pk=item.pk).update(related_stale=False)
+        item.related_stale = False
+        
+        tag_ids = item.get_tag_ids()
+        if not item.published or not item.publication_date or not tag_ids:
+            return
+        
+        pub = item.publication_date
+        shared = NewsItemTag.objects.filter(tag__in=tag_ids,
+            news_item__published=True).exclude(news_item=item).values_list(
+                'news_item', 'news_item__publication_date').annotate(
+                    shared=Count('pk'))
+        candidates = list(shared.filter(
+            news_item__publication_date__lte=pub).order_by('-shared',
+                '-news_item__publication_date')[:RELATED_ITEMS])
+        candidates.extend(shared.filter(
+            news_item__publication_date__gt=pub).order_by('-shared',
+                'news_item__publication_date')[:RELATED_ITEMS])
+        if not candidates:
+            return
+        
+        scores = []
+        for pk, publication_date, count in candidates:
+            days = abs((publication_date - pub).days)
+            scores.append((count + 1.0 / (1 + float(days) /
+                           RELATED_RECENCY_DAYS), pk))
+        scores.sort(reverse=True)
+        
+        bulk_insert(self.model, ('news_item', 'related', 'score'),
+                    [(item.pk, pk, score) for score, pk in
+                     scores[:RELATED_ITEMS]])
+    
+    def mark_stale(self, tag_ids):
+        """
+        Flag the news items using any of the tags for the next
+        newsy_refresh_related run.
+        """
+        if not tag_ids:
+            return
+        NewsItem.objects.filter(related_stale=False,
+            pk__in=NewsItemTag.objects.filter(tag__in=list(tag_ids)).values(
+                'news_item')).update(related_stale=True)
+
+class RelatedNewsItem(models.Model):
+    """
+    Precomputed related news, refreshed by the receivers in newsy.signals
+    and the newsy_refresh_related management command.
+    """
+    news_item = models.ForeignKey(NewsItem, related_name='related_entries',
+                                  on_delete=models.CASCADE)
+    related = models.ForeignKey(NewsItem, related_name='related_to_entries',
+                                on_delete=models.CASCADE)
+    score = models.FloatField()
+
+    objects = RelatedNewsItemManager()
+
+    class Meta:
+        ordering = ['-score']
+        unique_together = (('news_item', 'related'),)
+
+    def __unicode__(self):
+        return u'%s -> %s (%.2f)' % (self.news_item_id, self.related_id,
+                                     self.score,)
+
+class SlugRedirectManager(models.Manager):
+    def update_for_item(self, item):
+        """
+        Point every slug a published news item has had at its canonical URL
+        and add its current slug on each of its sites. The entries of
+        unpublished items are removed. Entries for sites the item has left
+        are kept, so its former slugs come back with the site, and are
+        ignored by resolve.
+        """
+        log.debug('SlugRedirectManager.update_for_item(%s)' % (
+                  unicode(item),))
+        entries = self.filter(news_item=item)
+        if not item.published or not item.publication_date:
+            entries.delete()
+            return
+        try:
+            url = item.get_absolute_url()
+        except NoReverseMatch:
+            log.warning('No URL for %s, slug redirects not updated' % (
+                        unicode(item),))
+            return
+        
+        slug = item.slug.lower()
+        site_ids = set(item.sites.values_list('pk', flat=True))
+        entries.exclude(url=url).update(url=url)
+        for site_id in site_ids - set(entries.filter(slug=slug).values_list(
+                'site', flat=True)):
+            self.create(site_id=site_id, slug=slug, news_item=item, url=url)
+    
+    def resolve(self, site_id, slug):
+        """
+        The canonical URL of the published news item known by the slug on
+        the site, or None when there is none or the slug is ambiguous.
+        """
+        urls = list(self.filter(site=site_id, slug=slug.lower(),
+            news_item__sites=site_id).values_list('url', flat=True)[:2])
+        if len(urls) == 1:
+            return urls[0]
+        return None
+
+class SlugRedirect(models.Model):
+    """
+    The current and former slugs of published news items with their
+    canonical URL on each site, maintained by the receivers in newsy.signals.
+    """
+    site = models.ForeignKey(Site)
+    slug = models.SlugField(max_length=255, db_index=False)
+    news_item = models.ForeignKey(NewsItem, related_name='slug_redirects',
+                                  on_delete=models.CASCADE)
+    url = models.CharField(max_length=255)
+
+    objects = SlugRedirectManager()
+
+    class Meta:
+        unique_together = (('site', 'slug', 'news_item'),)
+
+    def __unicode__(self):
+        return u'%s -> %s' % (self.slug, self.url,)
+
+LATEST_MAX_ITEMS = getattr(settings, 'NEWSY_LATEST_MAX_ITEMS', 50)
+LATEST_TEMPLATE_CACHE = getattr(settings, 'NEWSY_LATEST_TEMPLATE_CACHE', True)
+LATEST_FRAGMENT_CACHE_TIMEOUT = getattr(settings,
+    'NEWSY_LATEST_FRAGMENT_CACHE_TIMEOUT', 0)
+
+_latest_templates = {}
+
 class LatestNewsPlugin(CMSPlugin):
     limit = models.PositiveSmallIntegerField(default=0)
     tags = TagField()
@@ -231,25 +676,68 @@ class LatestNewsPlugin(CMSPlugin):
         
         return 'Latest news'
     
+    def get_item_ids(self):
+        """
+        The ids of the latest published news items with all of the plugin's
+        tags, at most limit or NEWSY_LATEST_MAX_ITEMS when there is no
+        limit. Cached until the news generation of the site changes.
+        """
+        site_id = get_current_site_id()
+        limit = self.limit > 0 and self.limit or LATEST_MAX_ITEMS
+        key = make_key('latest', site_id, get_generation(site_id), self.pk,
+                       limit, self.tags)
+        ids = cache.get(key)
+        if ids is None:
+            qs = NewsItem.site_objects.filter(published=True)
+            tags = parse_tag_input(self.tags)
+            if tags:
+                qs = filter_by_tags(qs, tags)
+            ids = list(qs.values_list('pk', flat=True)[:limit])
+            cache.set(key, ids, CACHE_TIMEOUT)
+        return ids
+    
     def items(self):
+        """
+        The latest news items as a list, loaded with their thumbnails.
+        """
         log.debug('%s.items()' % (repr(self),))
-        qs = NewsItem.site_objects.filter(published=True)
-        tags = Tag.objects.get_for_object(self)
-        
-        if tags:
-            qs = TaggedItem.objects.get_by_model(qs, tags)
-        
-        if self.limit > 0:
-            qs = qs[:self.limit]
-        
-        return qs
+        ids = self.get_item_ids()
+        if not ids:
+            return []
+        items = NewsItem.objects.select_related('thumbnail').in_bulk(ids)
+        return [items[pk] for pk in ids if pk in items]
     
     @property
     def render_template(self):
+        """
+        The template for the plugin's placeholder slot, looked up once per
+        slot and process unless NEWSY_LATEST_TEMPLATE_CACHE is False, and
+        wrapped in a CachedTemplate when
+        NEWSY_LATEST_FRAGMENT_CACHE_TIMEOUT is set.
+        """
+        slot = self.placeholder.slot.lower()
+        if LATEST_TEMPLATE_CACHE and slot in _latest_templates:
+            return _latest_templates[slot]
         log.debug('%s.render_template()' % (repr(self),))
-        return select_template([
-            'cms/plugins/newsy/%s-latest.html' % (self.placeholder.slot.lower(),),
+        template = select_template([
+            'cms/plugins/newsy/%s-latest.html' % (slot,),
             'cms/plugins/newsy/latest.html'])
+        if LATEST_FRAGMENT_CACHE_TIMEOUT:
+            template = CachedTemplate(template, LATEST_FRAGMENT_CACHE_TIMEOUT,
+                                      key_variable='newsy_fragment_key')
+        if LATEST_TEMPLATE_CACHE:
+            _latest_templates[slot] = template
+        return template
+    
+    def get_fragment_key(self, lang):
+        """
+        Cache key for the rendered plugin, replaced whenever the plugin or
+        the news generation of the site changes.
+        """
+        site_id = get_current_site_id()
+        return make_key('latest-fragment', site_id, get_generation(site_id),
+                        self.pk, lang, self.placeholder.slot, self.limit,
+                        self.tags)
     
     def copy_relations(self, oldinstance):
         log.debug('%s.copy_relations(%s)' % (repr(self), repr(oldinstance),))
@@ -0,0 +1,153 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from calendar import timegm
+from datetime import datetime, timedelta
+from logging import getLogger
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import Q
+
+
+
+log = getLogger('newsy.pagination')
+
+COUNT_CACHE_TIMEOUT = getattr(settings, 'NEWSY_COUNT_CACHE_TIMEOUT', 60 * 5)
+
+EPOCH = datetime(1970, 1, 1)
+
+def _encode_date(value):
+    seconds = timegm(value.utctimetuple())
+    return seconds * 1000000 + value.microsecond
+
+def _decode_date(value):
+    value = EPOCH + timedelta(microseconds=value)
+    if getattr(settings, 'USE_TZ', False):
+        from django.utils import timezone
+        value = timezone.make_aware(value, timezone.utc)
+    return value
+
+def encode_token(direction, item):
+    """
+    An opaque token for the items after (direction 'n') or before (direction
+    'p') the given item.
+    """
+    token = '%s:%d:%d' % (direction, _encode_date(item.publication_date),
+                          item.pk,)
+    return urlsafe_b64encode(token).rstrip('=')
+
+def decode_token(token):
+    """
+    The (direction, publication_date, pk) of a token made by encode_token.
+    Raises ValueError for tokens it did not make.
+    """
+    try:
+        token = urlsafe_b64decode(str(token) + '=' * (-len(token) % 4))
+        direction, date, pk = token.split(':')
+        date, pk = _decode_date(int(date)), int(pk)
+    except (TypeError, UnicodeError, ValueError, OverflowError):
+        raise ValueError('Invalid page token: %r' % (token,))
+    if direction not in ('n', 'p',):
+        raise ValueError('Invalid page token: %r' % (token,))
+    return (direction, date, pk,)
+
+class KeysetPage(object):
+    """
+    A page of a keyset paginated listing. Instead of page numbers it links to
+    the neighbouring pages with the next_token and previous_token.
+    """
+    def __init__(self, object_list, paginator, next_token=None,
+                 previous_token=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_token = next_token
+        self.previous_token = previous_token
+
+    def __repr__(self):
+        return '<KeysetPage of %d items>' % (len(self.object_list),)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_token is not None
+
+    def has_previous(self):
+        return self.previous_token is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+class KeysetPaginator(object):
+    """
+    Paginates news items newest first on (publication_date, pk) by seeking
+    past the last item shown instead of counting and offsetting, so every
+    page costs the same single query. Items without a publication date are
+    not listed.
+    """
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset.filter(publication_date__isnull=False)
+        self.per_page = int(per_page)
+
+    def page(self, token=None):
+        """
+        The page the token points at, or the first page without a token.
+        Raises ValueError for invalid tokens.
+        """
+        log.debug('KeysetPaginator.page(token=%s)' % (token,))
+        qs = self.queryset
+        direction = 'n'
+        if token:
+            direction, date, pk = decode_token(token)
+            if direction == 'n':
+                qs = qs.filter(Q(publication_date__lt=date) |
+                               Q(publication_date=date, pk__lt=pk))
+            else:
+                qs = qs.filter(Q(publication_date__gt=date) |
+                               Q(publication_date=date, pk__gt=pk))
+
+        if direction == 'n':
+            qs = qs.order_by('-publication_date', '-pk')
+        else:
+            qs = qs.order_by('publication_date', 'pk')
+        items = list(qs[:self.per_page + 1])
+        more = len(items) > self.per_page
+        items = items[:self.per_page]
+        if direction == 'p':
+            items.reverse()
+        if not items:
+            return KeysetPage(items, self)
+
+        if direction == 'n':
+            has_next, has_previous = more, bool(token)
+        else:
+            has_next, has_previous = True, more
+        return KeysetPage(items, self,
+            next_token=has_next and encode_token('n', items[-1]) or None,
+            previous_token=has_previous and encode_token('p', items[0]) or None)
+
+class CachedCountPaginator(Paginator):
+    """
+    Page number paginator that reads the number of items from the cache
+    under count_key, counting and caching it only on a miss.
+    """
+    def __init__(self, object_list, per_page, orphans=0,
+                 allow_empty_first_page=True, count_key=None,
+                 timeout=COUNT_CACHE_TIMEOUT):
+        super(CachedCountPaginator, self).__init__(object_list, per_page,
+            orphans=orphans, allow_empty_first_page=allow_empty_first_page)
+        self.count_key = count_key
+        self.timeout = timeout
+
+    def _get_count(self):
+        if self._count is None and self.count_key and self.timeout:
+            count = cache.get(self.count_key)
+            if count is None:
+                count = super(CachedCountPaginator, self)._get_count()
+                cache.set(self.count_key, count, self.timeout)
+            self._count = count
+        return super(CachedCountPaginator, self)._get_count()
+    count = property(_get_count)
@@ -1,27 +1,143 @@
 # -*- coding: utf-8 -*-
 from logging import getLogger
+import operator
+import os
 
 from cms.exceptions import DuplicatePlaceholderWarning
-from cms.models import Page
+from cms.models import Page, CMSPlugin
+from cms.plugin_pool import plugin_pool
 from cms.plugin_rendering import render_plugins
-from cms.plugins.utils import get_plugins
+from cms.plugins.utils import get_plugins, get_plugin_media
+from cms.utils.plugins import get_placeholders as scan_placeholders
 from cms.templatetags.cms_tags import Placeholder
+from cms.utils import get_language_from_request
+from cms.utils.moderator import get_cmsplugin_queryset
 from django.contrib.sites.models import Site
 from django.conf import settings
+from django.core.cache import cache
+from django.forms.widgets import Media
 from django.shortcuts import get_object_or_404
 from django.template import NodeList, TextNode, VariableNode, \
-    TemplateSyntaxError
+    TemplateDoesNotExist, TemplateSyntaxError
 from django.template.loader import get_template
 from django.template.loader_tags import ConstantIncludeNode, ExtendsNode, \
     BlockNode
 import warnings
 
+from newsy.cache import bump_generation_on_commit, get_generation, \
+    make_key
 from newsy.models import NewsItem
+from newsy.sites import get_current_site_id
 
 
 
 log = getLogger('newsy.placeholders')
 
+PLACEHOLDER_CACHE_TIMEOUT = getattr(settings,
+                                    'NEWSY_PLACEHOLDER_CACHE_TIMEOUT', 0)
+TEMPLATE_MTIME_CHECK = getattr(settings, 'NEWSY_TEMPLATE_MTIME_CHECK', False)
+
+_slots_cache = {}
+_slots_mtimes = {}
+
+def _template_names(name, seen=None):
+    """
+    The name of the template and of the templates it extends or includes.
+    """
+    if seen is None:
+        seen = set()
+    if name in seen:
+        return seen
+    seen.add(name)
+    try:
+        nodelist = get_template(name).nodelist
+    except (TemplateDoesNotExist, TemplateSyntaxError):
+        return seen
+    for node in nodelist.get_nodes_by_type(ExtendsNode):
+        if getattr(node, 'parent_name', None):
+            _template_names(node.parent_name, seen)
+    for node in nodelist.get_nodes_by_type(ConstantIncludeNode):
+        if getattr(node.template, 'name', None):
+            _template_names(node.template.name, seen)
+    return seen
+
+def _template_paths(names):
+    """
+    The source file of each template found in the template directories.
+    """
+    from django.template.loaders.app_directories import app_template_dirs
+    directories = tuple(settings.TEMPLATE_DIRS) + tuple(app_template_dirs)
+    paths = []
+    for name in names:
+        for directory in directories:
+            path = os.path.join(directory, name)
+            if os.path.exists(path):
+                paths.append(path)
+                break
+    return paths
+
+def _source_mtimes(paths):
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = os.path.getmtime(path)
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+def get_placeholders(template):
+    """
+    The placeholder slots in the template and the templates it extends or
+    includes, parsed once per process. With NEWSY_TEMPLATE_MTIME_CHECK the
+    slots are parsed again after one of those template files changes, for
+    development.
+    """
+    if TEMPLATE_MTIME_CHECK and template in _slots_cache:
+        mtimes = _slots_mtimes.get(template, {})
+        if _source_mtimes(mtimes.keys()) != mtimes:
+            del _slots_cache[template]
+    if template not in _slots_cache:
+        log.debug('get_placeholders(template=%s)' % (template,))
+        _slots_cache[template] = tuple(scan_placeholders(template))
+        if TEMPLATE_MTIME_CHECK:
+            _slots_mtimes[template] = _source_mtimes(_template_paths(
+                _template_names(template)))
+    return list(_slots_cache[template])
+
+def get_content_version(placeholder_id):
+    return get_generation(placeholder_id, namespace='placeholder')
+
+def get_content_generation():
+    """
+    Generation of the placeholder content of all news items, for caches
+    holding the content of whole pages.
+    """
+    return get_generation('all', namespace='content')
+
+def bump_content_version(placeholder_ids):
+    """
+    Invalidate the cached rendered content of the placeholders and the
+    content generation.
+    """
+    placeholder_ids = set(placeholder_ids)
+    if placeholder_ids:
+        bump_generation_on_commit(placeholder_ids, namespace='placeholder')
+        bump_generation_on_commit(['all'], namespace='content')
+
+def is_edit_mode(request):
+    """
+    True when a staff user is editing the page with the frontend editor.
+    """
+    if request is None:
+        return False
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_staff:
+        return False
+    session = getattr(request, 'session', {})
+    return 'edit' in request.GET or session.get('cms_edit', False)
+
+_extra_context_cache = {}
+
 def get_newsitem_from_placeholder_if_exists(placeholder):
     log.debug('get_newsitem_from_placeholder_if_exists(placeholder=%s)' % 
               (unicode(placeholder),))
@@ -30,17 +146,164 @@ def get_newsitem_from_placeholder_if_exists(placeholder):
     except (NewsItem.DoesNotExist, NewsItem.MultipleObjectsReturned):
         return None
 
-def render_newsy_placeholder(placeholder, context, name_fallback="Placeholder"):
+def set_placeholder_owner(placeholders, item):
+    """
+    Remember the news item that owns the placeholders so rendering them does
+    not have to look it up, and the placeholders loaded with each one so
+    load_plugins can load the plugins of all of them at once.
+    """
+    placeholders = list(placeholders)
+    for placeholder in placeholders:
+        placeholder._newsy_item_cache = item
+        placeholder._newsy_siblings_cache = placeholders
+
+def load_plugins(request, placeholders, lang=None):
+    """
+    Load the plugins of the placeholders in one query, downcast them with one
+    query per plugin type and store them where get_plugins and
+    CMSPlugin.get_plugin_instance look for them. Placeholders that already
+    have their plugins loaded are skipped.
+    """
+    lang = lang or get_language_from_request(request)
+    cache_name = '_%s_plugins_cache' % (lang,)
+    placeholders = dict([(placeholder.pk, placeholder)
+                         for placeholder in placeholders
+                         if not hasattr(placeholder, cache_name)])
+    if not placeholders:
+        return
+    log.debug('load_plugins(placeholders=%s, lang=%s)' % (
+        placeholders.keys(), lang,))
+    
+    top_level = dict([(pk, []) for pk in placeholders])
+    everything = dict([(pk, []) for pk in placeholders])
+    by_type = {}
+    for plugin in get_cmsplugin_queryset(request).filter(
+            placeholder__in=placeholders.keys(), language=lang).order_by(
+            'placeholder', 'position'):
+        plugin._placeholder_cache = placeholders[plugin.placeholder_id]
+        everything[plugin.placeholder_id].append(plugin)
+        if plugin.parent_id is None:
+            top_level[plugin.placeholder_id].append(plugin)
+        by_type.setdefault(plugin.plugin_type, []).append(plugin)
+    
+    for plugin_type, plugins in by_type.items():
+        try:
+            model = plugin_pool.get_plugin(plugin_type).model
+        except KeyError:
+            continue
+        if model is CMSPlugin:
+            continue
+        instances = model.objects.in_bulk([plugin.pk for plugin in plugins])
+        instance_cache_name = '_%s_cache' % (model.__name__.lower(),)
+        for plugin in plugins:
+            instance = instances.get(plugin.pk, None)
+            if instance is not None:
+                instance._placeholder_cache = plugin._placeholder_cache
+            setattr(plugin, instance_cache_name, instance)
+    
+    for pk, placeholder in placeholders.items():
+        setattr(placeholder, cache_name, top_level[pk])
+        placeholder._newsy_all_plugins_cache = everything[pk]
+
+def get_placeholder_media(request, context, placeholder):
+    """
+    The media of the plugins in the placeholder for the request language,
+    from the plugins loaded by load_plugins.
+    """
+    load_plugins(request, getattr(placeholder, '_newsy_siblings_cache',
+                                  [placeholder]))
+    plugins = getattr(placeholder, '_newsy_all_plugins_cache', None)
+    if plugins is None:
+        return placeholder.get_media(request, context)
+    media_classes = [get_plugin_media(request, context, plugin)
+                     for plugin in plugins]
+    if media_classes:
+        return reduce(operator.add, media_classes)
+    return Media()
+
+def get_placeholder_owner(placeholder, context):
+    """
+    The news item owning the placeholder: the remembered owner, else the
+    news item being rendered in the context, else a database lookup.
+    """
+    if not hasattr(placeholder, '_newsy_item_cache'):
+        page = context.get('current_page', None)
+        if not isinstance(page, NewsItem):
+            page = get_newsitem_from_placeholder_if_exists(placeholder)
+        placeholder._newsy_item_cache = page
+    return placeholder._newsy_item_cache
+
+def get_extra_context(template, slot):
+    """
+    The CMS_PLACEHOLDER_CONF extra context for the slot in the template,
+    falling back to the slot's configuration for any template.
+    """
+    key = (template, slot,)
+    if key not in _extra_context_cache:
+        conf = settings.CMS_PLACEHOLDER_CONF
+        extra_context = conf.get("%s %s" % (template, slot), {}).get(
+            "extra_context", None)
+        if not extra_context:
+            extra_context = conf.get(slot, {}).get("extra_context", {})
+        _extra_context_cache[key] = extra_context
+    return _extra_context_cache[key]
+
+def render_newsy_placeholder(placeholder, context, name_fallback="Placeholder",
+                             with_media=False):
     """
     Renders plugins for a placeholder on the given page using shallow copies of the 
     given context, and returns a string containing the rendered output.
+    With with_media a (content, media) tuple of the output and the media of
+    the placeholder's plugins is returned.
+    
+    The output and media are cached per placeholder and language until the
+    content version of the placeholder or the news generation of the site
+    is bumped, except for staff in edit mode, so a cache hit loads no
+    plugins. Content rendered while a CSRF token is in use is not cached,
+    since it may hold that visitor's token.
     """
     log.debug('render_newsy_placeholder(placeholder=%s)' % 
               (unicode(placeholder),))
     request = context.get('request', None)
+    if not PLACEHOLDER_CACHE_TIMEOUT or is_edit_mode(request):
+        content = _render_newsy_placeholder(placeholder, context,
+                                            name_fallback)
+        if with_media:
+            return (content, get_placeholder_media(request, context,
+                                                   placeholder),)
+        return content
+    
+    site_id = get_current_site_id()
+    key = make_key('placeholder-content', placeholder.pk,
+                   get_language_from_request(request),
+                   get_content_version(placeholder.pk), site_id,
+                   get_generation(site_id))
+    cached = cache.get(key)
+    if cached is None:
+        content = _render_newsy_placeholder(placeholder, context,
+                                            name_fallback)
+        media = None
+        if with_media:
+            media = get_placeholder_media(request, context, placeholder)
+        if request is None or \
+                not request.META.get('CSRF_COOKIE_USED', False):
+            cache.set(key, (content, media,), PLACEHOLDER_CACHE_TIMEOUT)
+    else:
+        content, media = cached
+        if with_media and media is None:
+            media = get_placeholder_media(request, context, placeholder)
+    if with_media:
+        return (content, media,)
+    return content
+
+def _render_newsy_placeholder(placeholder, context, name_fallback):
+    request = context.get('request', None)
     context.push()
+    if request is not None:
+        load_plugins(request, getattr(placeholder, '_newsy_siblings_cache',
+                                      [placeholder]))
     plugins = list(get_plugins(request, placeholder))
-    page = get_newsitem_from_placeholder_if_exists(placeholder)
+    page = get_placeholder_owner(placeholder, context)
     if page:
         template = page.template
     else:
@@ -52,9 +315,7 @@ def render_newsy_placeholder(placeholder, context, name_fallback="Placeholder"):
     slot = getattr(placeholder, 'slot', None)
     extra_context = {}
     if slot:
-        extra_context = settings.CMS_PLACEHOLDER_CONF.get("%s %s" % (template, slot), {}).get("extra_context", None)
-        if not extra_context:
-            extra_context = settings.CMS_PLACEHOLDER_CONF.get(slot, {}).get("extra_context", {})
+        extra_context = get_extra_context(template, slot)
     for key, value in extra_context.items():
         if not key in context:
             context[key] = value
@@ -66,3 +327,24 @@ def render_newsy_placeholder(placeholder, context, name_fallback="Placeholder"):
     content = "".join(c)
     context.pop()
     return content
+
+def render_newsitem_content(item, context):
+    """
+    Renders every placeholder of a news item in the order they appear in its
+    template and returns the combined output, e.g. for full content feeds.
+    """
+    log.debug('render_newsitem_content(item=%s)' % (unicode(item),))
+    placeholders = {}
+    for placeholder in item.placeholders.all():
+        placeholders[placeholder.slot] = placeholder
+    set_placeholder_owner(placeholders.values(), item)
+    
+    context.push()
+    context['current_page'] = item
+    content = []
+    for slot in get_placeholders(item.get_template()):
+        if slot in placeholders:
+            content.append(render_newsy_placeholder(placeholders[slot],
+                                                    context, slot))
+    context.pop()
+    return u''.join(content)
@@ -1,17 +1,200 @@
+from contextlib import contextmanager
 from datetime import datetime
+from threading import local
 
-from django.db.models.signals import pre_save, post_save
+from django.conf import settings
+from django.db.models.signals import pre_save, post_save, pre_delete, \
+    post_delete, m2m_changed
 from django.dispatch import receiver
 
-from newsy.models import NewsItem
+from newsy.cache import bump_generation_on_commit
+from newsy.models import NewsItem, ArchiveEntry, TagUsage, RelatedNewsItem, \
+    SlugRedirect, NewsItemTag, create_missing_placeholders
 
 
 
+RELATED_DEFERRED = getattr(settings, 'NEWSY_RELATED_DEFERRED', True)
+
+ARCHIVE_FIELDS = ('title', 'short_title', 'slug', 'published',
+                  'publication_date',)
+TAG_USAGE_FIELDS = ('tags', 'published',)
+RELATED_FIELDS = ('tags', 'published', 'publication_date',)
+TRACKED_FIELDS = ARCHIVE_FIELDS + ('tags', 'related_stale', 'template',)
+
+_rescans = local()
+
+def _changed(instance, fields):
+    """
+    True when any of the fields differ from the values remembered before the
+    instance was saved, or when there is nothing to compare against.
+    """
+    previous = getattr(instance, '_newsy_previous', None)
+    if previous is None:
+        return True
+    for field in fields:
+        if previous[field] != getattr(instance, field):
+            return True
+    return False
+
+def _site_ids(instance):
+    if not instance.pk:
+        return []
+    return list(instance.sites.values_list('pk', flat=True))
+
 @receiver(pre_save, sender=NewsItem)
 def set_publication_date_if_published(instance, **kwargs):
     if hasattr(instance, 'published') and instance.published and not instance.publication_date:
         instance.publication_date = datetime.now()
 
+@receiver(pre_save, sender=NewsItem)
+def remember_previous_values(instance, **kwargs):
+    instance._newsy_previous = None
+    instance._newsy_previous_tag_ids = []
+    if instance.pk:
+        previous = NewsItem.objects.filter(pk=instance.pk).values(
+            *TRACKED_FIELDS)
+        if previous:
+            instance._newsy_previous = previous[0]
+            # the flag is owned by the related news refresh, not the editor
+            instance.related_stale = previous[0]['related_stale']
+            if _changed(instance, RELATED_FIELDS):
+                instance._newsy_previous_tag_ids = instance.get_tag_ids()
+
+@contextmanager
+def suspend_placeholder_rescans():
+    """
+    Skip the placeholder rescans of the news items saved in this thread
+    inside the block, e.g. for bulk saves, and rescan each of them once when
+    the block exits without an error.
+    """
+    if getattr(_rescans, 'pending', None) is not None:
+        yield
+        return
+    _rescans.pending = set()
+    try:
+        yield
+    except:
+        _rescans.pending = None
+        raise
+    pending, _rescans.pending = _rescans.pending, None
+    reconcile_placeholders(pending)
+
+def reconcile_placeholders(pks, chunk_size=500):
+    """
+    Rescan the placeholders of the news items with the given primary keys.
+    """
+    pks = sorted(pks)
+    for start in xrange(0, len(pks), chunk_size):
+        create_missing_placeholders(NewsItem.objects.filter(
+            pk__in=pks[start:start + chunk_size]))
+
+@receiver(post_save, sender=NewsItem)
+def update_placeholders(instance, created, **kwargs):
+    if not created and not _changed(instance, ('template',)):
+        return
+    pending = getattr(_rescans, 'pending', None)
+    if pending is not None:
+        pending.add(instance.pk)
+    else:
+        instance.rescan_placeholders()
+
+@receiver(post_save, sender=NewsItem)
+def update_newsitem_tags(instance, created, **kwargs):
+    if created or _changed(instance, ('tags',)):
+        NewsItemTag.objects.sync_item(instance)
+
+@receiver(post_save, sender=NewsItem)
+def bump_placeholder_versions(instance, created, **kwargs):
+    """
+    The CMS_PLACEHOLDER_CONF extra context depends on the template and
+    reverting a revision saves the item with its plugins, so every save
+    invalidates the cached placeholder content.
+    """
+    if not created:
+        from newsy.placeholders import bump_content_version
+        bump_content_version(instance.placeholders.values_list('pk',
+                                                               flat=True))
+
+@receiver(post_save, sender=NewsItem)
+def update_archive(instance, created, **kwargs):
+    if created or _changed(instance, ARCHIVE_FIELDS):
+        ArchiveEntry.objects.update_for_item(instance)
+
+@receiver(post_save, sender=NewsItem)
+def update_slug_redirects(instance, created, **kwargs):
+    if created or _changed(instance, ARCHIVE_FIELDS):
+        SlugRedirect.objects.update_for_item(instance)
+
+@receiver(post_save, sender=NewsItem)
+def update_tag_usage(instance, created, **kwargs):
+    if created or _changed(instance, TAG_USAGE_FIELDS):
+        tag_ids = set(getattr(instance, '_newsy_previous_tag_ids', []))
+        tag_ids.update(instance.get_tag_ids())
+        TagUsage.objects.refresh(_site_ids(instance), tag_ids)
+
 @receiver(post_save, sender=NewsItem)
-def update_placeholders(instance, **kwargs):
-    instance.rescan_placeholders()
\ No newline at end of file
+def update_related_news(instance, created, **kwargs):
+    """
+    Refresh the related news for the saved item and flag the items sharing
+    its old or new tags for the newsy_refresh_related command.
+    """
+    if created or _changed(instance, RELATED_FIELDS):
+        tag_ids = set(getattr(instance, '_newsy_previous_tag_ids', []))
+        tag_ids.update(instance.get_tag_ids())
+        RelatedNewsItem.objects.mark_stale(tag_ids)
+        if RELATED_DEFERRED:
+            NewsItem.objects.filter(pk=instance.pk).update(related_stale=True)
+        else:
+            RelatedNewsItem.objects.refresh(instance)
+
+@receiver(post_save, sender=NewsItem)
+def bump_generation_on_save(instance, **kwargs):
+    bump_generation_on_commit(_site_ids(instance))
+
+@receiver(pre_delete, sender=NewsItem)
+def remember_deleted_item(instance, **kwargs):
+    instance._newsy_deleted_site_ids = _site_ids(instance)
+    instance._newsy_deleted_tag_ids = instance.get_tag_ids()
+    bump_generation_on_commit(instance._newsy_deleted_site_ids)
+
+@receiver(post_delete, sender=NewsItem)
+def update_indexes_on_delete(instance, **kwargs):
+    TagUsage.objects.refresh(instance._newsy_deleted_site_ids,
+                             instance._newsy_deleted_tag_ids)
+    RelatedNewsItem.objects.mark_stale(instance._newsy_deleted_tag_ids)
+
+@receiver(m2m_changed, sender=NewsItem.sites.through)
+def update_site_indexes(instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep the per-site indexes in step with the sites a news item is on.
+    Assigning the sites clears them before adding the new ones, so the slug
+    redirects are only updated once sites are added or removed; those of the
+    sites an item has left are ignored by SlugRedirect.objects.resolve.
+    """
+    if reverse:
+        if action == 'post_clear':
+            ArchiveEntry.objects.filter(site=instance).delete()
+        elif action in ('post_add', 'post_remove'):
+            for item in NewsItem.objects.filter(pk__in=pk_set):
+                ArchiveEntry.objects.update_for_item(item)
+                SlugRedirect.objects.update_for_item(item)
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            TagUsage.objects.refresh([instance.pk])
+            bump_generation_on_commit([instance.pk])
+        return
+
+    if action == 'pre_clear':
+        instance._newsy_cleared_site_ids = _site_ids(instance)
+        return
+    elif action == 'post_clear':
+        site_ids = getattr(instance, '_newsy_cleared_site_ids', [])
+    elif action in ('post_add', 'post_remove'):
+        site_ids = pk_set
+    else:
+        return
+
+    ArchiveEntry.objects.update_for_item(instance)
+    if action != 'post_clear':
+        SlugRedirect.objects.update_for_item(instance)
+    TagUsage.objects.refresh(site_ids, instance.get_tag_ids())
+    bump_generation_on_commit(site_ids)
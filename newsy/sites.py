@@ -0,0 +1,116 @@
+from contextlib import contextmanager
+from logging import getLogger
+from threading import local
+from time import time
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from newsy.cache import CACHE_TIMEOUT
+
+
+
+log = getLogger('newsy.sites')
+
+HOST_SITES = getattr(settings, 'NEWSY_HOST_SITES', False)
+
+_state = local()
+_host_sites = {}
+
+def get_site_for_host(host):
+    """
+    The site whose domain matches the host, with or without its port, or the
+    SITE_ID site when none does. Matches are kept in a per-process map for
+    NEWSY_CACHE_TIMEOUT seconds; unknown hosts are looked up every time.
+    """
+    host = host.lower()
+    site, expires = _host_sites.get(host, (None, 0,))
+    if expires > time():
+        return site
+    log.debug('get_site_for_host(%s)' % (host,))
+    sites = Site.objects.filter(domain__in=set([host, host.split(':')[0]]))
+    sites = dict([(site.domain.lower(), site) for site in sites])
+    site = sites.get(host, sites.get(host.split(':')[0], None))
+    if site is None:
+        _host_sites.pop(host, None)
+        return Site.objects.get_current()
+    _host_sites[host] = (site, time() + CACHE_TIMEOUT,)
+    return site
+
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+def clear_host_sites(**kwargs):
+    _host_sites.clear()
+
+def set_current_site(site):
+    """
+    Make the site the current site of this thread, or with None go back to
+    the SITE_ID site.
+    """
+    _state.site = site
+
+def get_current_site():
+    """
+    The site set for the current request by CurrentSiteMiddleware, else the
+    SITE_ID site.
+    """
+    site = getattr(_state, 'site', None)
+    if site is None:
+        site = Site.objects.get_current()
+    return site
+
+@contextmanager
+def pinned_site(site):
+    """
+    Make the site the current site of this thread inside the block, e.g.
+    while a streamed response is written after the request has ended.
+    """
+    previous = getattr(_state, 'site', None)
+    set_current_site(site)
+    try:
+        yield
+    finally:
+        set_current_site(previous)
+
+def get_current_site_id():
+    site = getattr(_state, 'site', None)
+    if site is None:
+        return settings.SITE_ID
+    return site.pk
+
+class CurrentSiteMiddleware(object):
+    """
+    Resolve the current site once per request. With NEWSY_HOST_SITES the
+    site is looked up from the request host, so one process can serve the
+    news of many sites; otherwise it is the SITE_ID site.
+    """
+    def process_request(self, request):
+        if HOST_SITES:
+            site = get_site_for_host(request.get_host())
+        else:
+            site = Site.objects.get_current()
+        set_current_site(site)
+        request.newsy_site = site
+
+    def process_response(self, request, response):
+        set_current_site(None)
+        return response
+
+    def process_exception(self, request, exception):
+        set_current_site(None)
+
+class CurrentSiteManager(models.Manager):
+    """
+    Limits the queryset to the objects on the current site of newsy, like
+    django.contrib.sites.managers.CurrentSiteManager does for SITE_ID.
+    """
+    def __init__(self, field_name='sites'):
+        super(CurrentSiteManager, self).__init__()
+        self.field_name = field_name
+
+    def get_query_set(self):
+        return super(CurrentSiteManager, self).get_query_set().filter(
+            **{'%s__id__exact' % (self.field_name,): get_current_site_id()})
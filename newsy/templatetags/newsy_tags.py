@@ -5,7 +5,8 @@ from django import template
 
 from cms.templatetags.cms_tags import Placeholder, PluginsMedia
 
-from newsy.placeholders import render_newsy_placeholder
+from newsy.placeholders import render_newsy_placeholder, \
+    set_placeholder_owner
 
 
 
@@ -18,6 +19,7 @@ def _get_placeholder(page, name):
         
         for placeholder in page.placeholders.all():
             cache[placeholder.slot] = placeholder
+        set_placeholder_owner(cache.values(), page)
         
         page._tmp_placeholders_cache = cache
     
@@ -52,9 +54,10 @@ class NewsyPlaceholder(Placeholder):
         if placeholder:
             request = context.get('request', None)
             if request and hasattr(request, 'placeholder_media'):
-                request.placeholder_media = reduce(operator.add, [request.placeholder_media, placeholder.get_media(request, context)])
-        
-            content = render_newsy_placeholder(placeholder, context, name)
+                content, media = render_newsy_placeholder(placeholder, context, name, with_media=True)
+                request.placeholder_media = reduce(operator.add, [request.placeholder_media, media])
+            else:
+                content = render_newsy_placeholder(placeholder, context, name)
         else:
             content = None
         
@@ -2,7 +2,7 @@ from django.conf import settings
 from django.conf.urls.defaults import url, patterns
 
 from newsy.models import NewsItem
-from newsy.feeds import RssNewsItemFeed
+from newsy.feeds import RssNewsItemFeed, AtomNewsItemFeed
 
 
 
@@ -20,8 +20,11 @@ urlpatterns = patterns('newsy.views',
     url(r'^upcoming/(?P<slug>[\-\d\w]+)/$','unpublished_item_view',
         name='unpublished-item-view'),
     url(r'^tag/$', 'tags_view', name='tags-view'),
-    url(r'^tag/(?P<tag>[\d\w\- &]{1,64})/$', 'item_list', name='tag-view'),
+    url(r'^tag/(?P<tag>[\d\w\- &+,]{1,255})/$', 'item_list', name='tag-view'),
     url(r'^rss/', RssNewsItemFeed(), name='newsy-rss-feed'),
     url(r'^tag/(?P<tag>[\d\w\- &]{1,64})/rss/$', RssNewsItemFeed(),
         name='newsy-rss-tag-feed'),
+    url(r'^atom/', AtomNewsItemFeed(), name='newsy-atom-feed'),
+    url(r'^tag/(?P<tag>[\d\w\- &]{1,64})/atom/$', AtomNewsItemFeed(),
+        name='newsy-atom-tag-feed'),
 )
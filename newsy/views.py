@@ -1,41 +1,101 @@
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
+from functools import wraps
 
+from django.conf import settings
 from django.contrib.auth.decorators import permission_required
-from django.http import Http404, HttpResponseServerError, HttpResponseRedirect
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, HttpResponseServerError, \
+    HttpResponsePermanentRedirect
 from django.shortcuts import render_to_response
 from django.template.context import RequestContext
+from django.utils.cache import has_vary_header
 from django.views.generic.list import ListView
 
 from cms.utils import get_language_from_request
 
-from tagging.models import TaggedItem, Tag
+from newsy.cache import CACHE_TIMEOUT, get_generation, make_key
+from newsy.models import NewsItem, TagUsage, SlugRedirect, filter_by_tags, \
+    prefetch_tags
+from newsy.pagination import CachedCountPaginator, KeysetPaginator
+from newsy.placeholders import get_content_generation, is_edit_mode
+from newsy.sites import get_current_site_id
 
-from newsy.models import NewsItem
 
 
+PAGE_CACHE_TIMEOUT = getattr(settings, 'NEWSY_PAGE_CACHE_TIMEOUT', 0)
+PAGINATION = getattr(settings, 'NEWSY_PAGINATION', 'page')
+
+def get_date_range(year, month=None, day=None):
+    """
+    The half-open (start, end) datetime range covering a year, month or day,
+    in UTC when USE_TZ is enabled like the item URLs and the archive index.
+    Unlike __year/__month/__day lookups, a range filter can use the
+    publication_date index. Raises ValueError for dates that do not exist.
+    """
+    year = int(year)
+    if month and day:
+        start = datetime(year, int(month), int(day))
+        end = start + timedelta(days=1)
+    elif month:
+        month = int(month)
+        start = datetime(year, month, 1)
+        end = datetime(year + month / 12, month % 12 + 1, 1)
+    else:
+        start = datetime(year, 1, 1)
+        end = datetime(year + 1, 1, 1)
+    
+    if getattr(settings, 'USE_TZ', False):
+        from django.utils import timezone
+        start = timezone.make_aware(start, timezone.utc)
+        end = timezone.make_aware(end, timezone.utc)
+    return (start, end)
+
+def parse_tag_filter(value):
+    """
+    Split a tag filter from a URL into tag names and whether items must have
+    all of them: 'a+b' matches items tagged with both, 'a,b' items tagged with
+    either.
+    """
+    if ',' in value:
+        names, match_all = value.split(','), False
+    else:
+        names, match_all = value.split('+'), True
+    return ([name.strip() for name in names if name.strip()], match_all,)
+
+def get_date_filters(year, month=None, day=None):
+    try:
+        start, end = get_date_range(year, month, day)
+    except ValueError:
+        raise Http404()
+    return {'publication_date__gte': start, 'publication_date__lt': end}
 
 class NewsListView(ListView):
     queryset = NewsItem.site_objects
     published = True
+    pagination = 'page'
+    page_token_kwarg = 'cursor'
+    paginator_class = CachedCountPaginator
     
     def get_tags(self):
-        tags = getattr(self, 'tags', [])
+        tags = list(getattr(self, 'tags', []))
         kwargs = getattr(self, 'kwargs', {})
-        if 'tag' in kwargs:
-            tags.append(kwargs['tag'])
+        if kwargs.get('tag', None):
+            tags.extend(parse_tag_filter(kwargs['tag'])[0])
         
         return tags
     
+    def get_tags_match_all(self):
+        kwargs = getattr(self, 'kwargs', {})
+        if kwargs.get('tag', None):
+            return parse_tag_filter(kwargs['tag'])[1]
+        return True
+    
     def get_date_filters(self):
-        filters = {}
         kwargs = getattr(self, 'kwargs', {})
-        if kwargs.get('year', None):
-            filters['publication_date__year'] = kwargs['year']
-        if kwargs.get('month', None):
-            filters['publication_date__month'] = kwargs['month']
-        if kwargs.get('day', None):
-            filters['publication_date__day'] = kwargs['day']
-        return filters
+        if not kwargs.get('year', None):
+            return {}
+        return get_date_filters(kwargs['year'], kwargs.get('month', None),
+                                kwargs.get('day', None))
     
     def get_queryset(self):
         qs = super(NewsListView, self).get_queryset()
@@ -50,42 +110,157 @@ class NewsListView(ListView):
         date_filters = self.get_date_filters()
         
         if tags:
-            qs = TaggedItem.objects.get_by_model(qs, tags)
+            qs = filter_by_tags(qs, tags, self.get_tags_match_all())
         
         if date_filters:
             qs = qs.filter(**date_filters)
         
         return qs
     
+    def get_count_key(self):
+        """
+        Cache key for the number of items listed, replaced whenever the news
+        generation of the site changes.
+        """
+        kwargs = getattr(self, 'kwargs', {})
+        site_id = get_current_site_id()
+        return make_key('count', site_id, get_generation(site_id),
+                        getattr(self, 'published', True),
+                        self.get_tags_match_all(),
+                        ','.join(sorted(set(self.get_tags()))),
+                        kwargs.get('year', None), kwargs.get('month', None),
+                        kwargs.get('day', None))
+    
+    def get_paginator(self, queryset, per_page, orphans=0,
+                      allow_empty_first_page=True):
+        return self.paginator_class(queryset, per_page, orphans=orphans,
+            allow_empty_first_page=allow_empty_first_page,
+            count_key=self.get_count_key())
+    
+    def paginate_queryset(self, queryset, page_size):
+        """
+        Paginate by page number, or with pagination = 'keyset' by the opaque
+        token in the page_token_kwarg request parameter.
+        """
+        if self.pagination == 'keyset':
+            paginator = KeysetPaginator(queryset, page_size)
+            try:
+                page = paginator.page(self.request.GET.get(
+                    self.page_token_kwarg, None))
+            except ValueError:
+                raise Http404()
+            is_paginated = page.has_other_pages()
+        else:
+            paginator, page, object_list, is_paginated = super(NewsListView,
+                self).paginate_queryset(queryset, page_size)
+        page.object_list = prefetch_tags(page.object_list)
+        return (paginator, page, page.object_list, is_paginated)
+    
     def get_context_data(self, **kwargs):
         context = super(NewsListView, self).get_context_data(**kwargs)
         tags = self.get_tags()
         if tags:
             context['news_tags'] = tags
+            context['news_tags_match_all'] = self.get_tags_match_all()
         context['news_year'] = getattr(self, 'kwargs', {}).get('year', None)
         context['news_month'] = getattr(self, 'kwargs', {}).get('month', None)
         context['news_day'] = getattr(self, 'kwargs', {}).get('day', None)
 
         return context
 
-item_list = NewsListView.as_view(paginate_by=15)
+item_list = NewsListView.as_view(paginate_by=15, pagination=PAGINATION)
 upcoming_item_list = permission_required('newsy.change_newsitem')(
     NewsListView.as_view(published=False, paginate_by=15))
 
+def get_item_for_date(year, month, day, slug):
+    """
+    The news item on the current site with the slug published on the given
+    day. Raises NewsItem.DoesNotExist when there is none or the date does not
+    exist.
+    """
+    try:
+        start, end = get_date_range(year, month, day)
+    except ValueError:
+        raise NewsItem.DoesNotExist()
+    return NewsItem.site_objects.get(published=True,
+                                     publication_date__gte=start,
+                                     publication_date__lt=end, slug=slug)
+
+def get_redirect_url(slug):
+    """
+    The canonical URL of the published news item known by the slug on the
+    current site, or an empty string. Cached until the news generation of
+    the site changes.
+    """
+    site_id = get_current_site_id()
+    key = make_key('slug-redirect', site_id, get_generation(site_id), slug)
+    url = cache.get(key)
+    if url is None:
+        url = SlugRedirect.objects.resolve(site_id, slug) or ''
+        cache.set(key, url, CACHE_TIMEOUT)
+    return url
+
+def is_page_cacheable(request, response):
+    """
+    Whether the response can be served to every anonymous visitor: it must
+    be successful, must not use or set cookies, like a CSRF token, and must
+    not vary on them.
+    """
+    return response.status_code == 200 and \
+        not request.META.get('CSRF_COOKIE_USED', False) and \
+        not response.cookies and not has_vary_header(response, 'Cookie')
+
+def cache_page_for_anonymous(view):
+    """
+    Cache successful responses of the view for anonymous GET requests when
+    NEWSY_PAGE_CACHE_TIMEOUT is set. The key includes the site's news
+    generation and the content generation, so saving a news item or editing
+    its plugins replaces the cached pages.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not PAGE_CACHE_TIMEOUT or \
+                request.method not in ('GET', 'HEAD',) or \
+                request.user.is_authenticated() or is_edit_mode(request):
+            return view(request, *args, **kwargs)
+        
+        site_id = get_current_site_id()
+        key = make_key('page', site_id, get_language_from_request(request),
+                       request.path, get_generation(site_id),
+                       get_content_generation())
+        cached = cache.get(key)
+        if cached is not None:
+            content, headers = cached
+            response = HttpResponse(content)
+            for header, value in headers:
+                response[header] = value
+            return response
+        
+        response = view(request, *args, **kwargs)
+        if is_page_cacheable(request, response):
+            cache.set(key, (response.content, response.items(),),
+                      PAGE_CACHE_TIMEOUT)
+        return response
+    return wrapper
+
+@cache_page_for_anonymous
 def item_view(request, year, month, day, slug):
     try:
-        page = NewsItem.objects.get(publication_date__year=year,
-                                    publication_date__month=month,
-                                    publication_date__day=day,
-                                    slug=slug)
+        page = get_item_for_date(year, month, day, slug)
     except NewsItem.MultipleObjectsReturned:
         raise Http404()
     except NewsItem.DoesNotExist:
-        try:
-            page = NewsItem.objects.get(slug=slug)
-            return HttpResponseRedirect(page.get_absolute_url())
-        except NewsItem.DoesNotExist, NewsItem.MultipleObjectsReturned:
+        # outdated or differently cased URLs redirect to the canonical one
+        url = get_redirect_url(slug.lower())
+        if not url and slug != slug.lower():
+            try:
+                url = get_item_for_date(year, month, day,
+                                        slug.lower()).get_absolute_url()
+            except (NewsItem.DoesNotExist, NewsItem.MultipleObjectsReturned):
+                pass
+        if not url or url == request.path:
             raise Http404()
+        return HttpResponsePermanentRedirect(url)
 
     context = RequestContext(request)
     context['lang'] = get_language_from_request(request)
@@ -113,23 +288,13 @@ def unpublished_item_view(request, slug):
     return render_to_response(page.template, context)
 
 def archive_view(request, year, month=None, day=None, **kwargs):
-    kwargs.setdefault('filters', {})
-    kwargs['filters']['publication_date__year'] = year
-    
-    if day:
-        kwargs['filters']['publication_date__day'] = day
-    if month:
-        kwargs['filters']['publication_date__month'] = month
-    
-    return item_list(request, **kwargs)
+    return item_list(request, year=year, month=month, day=day, **kwargs)
 
 class TagsView(ListView):
     template_name = 'newsy/tag_list.html'
 
     def get_queryset(self, *args, **kwargs):
-        return Tag.objects.usage_for_queryset(
-                NewsItem.site_objects.filter(published=True),
-                counts=True)
+        return TagUsage.objects.tags_for_site(get_current_site_id())
 
 tags_view = TagsView.as_view()
 
@@ -24,7 +24,7 @@ setup(
     author = 'Benjamin Liles',
     author_email = 'ben@ltwebdev.com',
     url = 'https://github.com/benliles/cmsplugin-newsy',
-    packages = find_packages(),
+    packages = find_packages(exclude=['benchmarks', 'benchmarks.*']),
     include_package_data = True,
     zip_safe = False,
     install_requires = [